@@ -23,9 +23,9 @@ class Memory(addrspace.BufferAddrSpace):
     def __init__(self) -> None:
         super().__init__(0, 0xFFFFFFFF, "memory", False)
         for memcfg in (PHYMEM, CLINT):
-            self.sub_space.append(addrspace.BufferAddrSpace(*memcfg, True))
+            self.add(addrspace.BufferAddrSpace(*memcfg, True))
         ctrl = Ctrl(0x123, 0x123, "ctrl", False)
-        self.sub_space.append(ctrl)
+        self.add(ctrl)
 
 
 memory = Memory()
@@ -1,52 +1,67 @@
 import logging
-
-from . import util
+import mmap
+import struct
 
 
 class ByteWrap:
+    """
+    Typed little endian access, space.u32[addr]. Plain memory is unpacked
+    from and packed into the buffer backing returns, devices go through
+    read and write. An access running past the end of a region raises
+    InvalidAddress.
+    """
 
-    SIGN_LEN_FUNC_READ_MAP = {
-        True: {
-            1: util.LittleEndness.read8s,
-            2: util.LittleEndness.read16s,
-            4: util.LittleEndness.read32s,
-            8: util.LittleEndness.read64s,
-        },
-        False: {
-            1: util.LittleEndness.read8u,
-            2: util.LittleEndness.read16u,
-            4: util.LittleEndness.read32u,
-            8: util.LittleEndness.read64u,
-        },
-    }
-
-    SIGN_LEN_FUNC_WRITE_MAP = {
-        True: {
-            1: util.LittleEndness.write8s,
-            2: util.LittleEndness.write16s,
-            4: util.LittleEndness.write32s,
-            8: util.LittleEndness.write64s,
-        },
-        False: {
-            1: util.LittleEndness.write8u,
-            2: util.LittleEndness.write16u,
-            4: util.LittleEndness.write32u,
-            8: util.LittleEndness.write64u,
-        },
+    FORMATS = {
+        (True, 1): "<b",
+        (True, 2): "<h",
+        (True, 4): "<i",
+        (True, 8): "<q",
+        (False, 1): "<B",
+        (False, 2): "<H",
+        (False, 4): "<I",
+        (False, 8): "<Q",
     }
 
     def __init__(self, signed, byte_len, _addrspace) -> None:
         if byte_len not in (1, 2, 4, 8):
             raise ValueError("byte_len {} not valid".format(byte_len))
         self._addrspace = _addrspace
-        self._read_func = ByteWrap.SIGN_LEN_FUNC_READ_MAP[bool(signed)][byte_len]
-        self._write_func = ByteWrap.SIGN_LEN_FUNC_WRITE_MAP[bool(signed)][byte_len]
+        self.struct = struct.Struct(ByteWrap.FORMATS[(bool(signed), byte_len)])
+        self._size = byte_len
+        self._unpack = self.struct.unpack_from
+        self._pack = self.struct.pack_into
+        self._backing = _addrspace.backing
 
     def __getitem__(self, key):
-        return self._read_func(self._addrspace, key)
+        mem, index = self._backing(key)
+        try:
+            if mem is not None:
+                return self._unpack(mem, index)[0]
+            return self._unpack(self._addrspace.read(key, self._size))[0]
+        except struct.error:
+            raise InvalidAddress(
+                "{} read of {} bytes at {} out of bounds".format(
+                    self._addrspace.name, self._size, hex(key)
+                )
+            ) from None
 
     def __setitem__(self, key, value):
-        return self._write_func(self._addrspace, key, value)
+        mem, index = self._backing(key)
+        if mem is not None:
+            try:
+                self._pack(mem, index, value)
+            except struct.error:
+                if index + self._size <= len(mem):
+                    raise  # the value, not the address
+                raise InvalidAddress(
+                    "{} write of {} bytes at {} out of bounds".format(
+                        self._addrspace.name, self._size, hex(key)
+                    )
+                ) from None
+            return
+        data = bytearray(self._size)
+        self._pack(data, 0, value)
+        self._addrspace.write(key, data)
 
 
 class InvalidAddress(Exception):
@@ -82,39 +97,165 @@ class AddrSpace:
     def write(self, addr, data):
         raise NotImplementedError()
 
+    def backing(self, addr):
+        """
+        return (memoryview, index of addr in it) when addr is plain memory
+        that may be accessed directly, (None, 0) for devices
+        """
+        return None, 0
+
     def __repr__(self) -> str:
         # return "{}(name:{}, base:{}, end:{}, sub_space:{})".format(self.__class__.__name__, self.name, self.base, self.end, self.sub_space)
         d = dict(self.__dict__)
         del d["mem"]
+        d.pop("_frames", None)
         return "{}[{}]".format(self.__class__.__name__, repr(d))
 
 
 class BufferAddrSpace(AddrSpace):
+    """
+    Dispatches to sub spaces, addresses outside all of them use self.mem.
+    Sub spaces are found through a table of 4 KiB frames, filled on first
+    access and reset when add or remove changes the map. Accesses running
+    past the end of self.mem raise InvalidAddress.
+    """
 
     def __init__(self, base, size, name=None, init_mem=False) -> None:
         super().__init__(base, size, name, init_mem)
-        self.sub_space = []
+        self.sub_space = ()
+        self._frames = {}  # {addr >> 12:(sub spaces overlapping the frame)}
+        self.map_listeners = []  # called after add and remove
+
+    def add(self, sub):
+        self.sub_space += (sub,)
+        self._map_changed()
+
+    def remove(self, sub):
+        self.sub_space = tuple(s for s in self.sub_space if s is not sub)
+        self._map_changed()
+
+    def _map_changed(self):
+        self._frames.clear()
+        for func in self.map_listeners:
+            func()
+
+    def _frame(self, addr):
+        start = addr & ~0xFFF
+        subs = self._frames[addr >> 12] = tuple(
+            sub
+            for sub in self.sub_space
+            if sub.base <= start + 0xFFF and start <= sub.end
+        )
+        return subs
+
+    def find(self, addr):
+        """return the sub space holding addr, None for self"""
+        subs = self._frames.get(addr >> 12)
+        if subs is None:
+            subs = self._frame(addr)
+        for sub in subs:
+            if sub.base <= addr <= sub.end:
+                return sub
+        return None
 
     def read(self, addr, length):
-        for sub in self.sub_space:
-            if sub.contain(addr):
-                return sub.read(addr, length)
+        if self.sub_space:
+            subs = self._frames.get(addr >> 12)
+            if subs is None:
+                subs = self._frame(addr)
+            for sub in subs:
+                if sub.base <= addr <= sub.end:
+                    return sub.read(addr, length)
         if self.mem:
             offset = addr - self.base
+            if offset + length > len(self.mem):
+                raise InvalidAddress(
+                    "{} read of {} bytes at {} out of bounds".format(
+                        self.name, length, hex(addr)
+                    )
+                )
             return self.mem[offset : offset + length]
         raise InvalidAddress("{} unhandled read at {}".format(self.name, hex(addr)))
 
     def write(self, addr, data):
-        for sub in self.sub_space:
-            if sub.contain(addr):
-                sub.write(addr, data)
-                return
+        if self.sub_space:
+            subs = self._frames.get(addr >> 12)
+            if subs is None:
+                subs = self._frame(addr)
+            for sub in subs:
+                if sub.base <= addr <= sub.end:
+                    sub.write(addr, data)
+                    return
         if self.mem:
             offset = addr - self.base
+            if offset + len(data) > len(self.mem):
+                raise InvalidAddress(
+                    "{} write of {} bytes at {} out of bounds".format(
+                        self.name, len(data), hex(addr)
+                    )
+                )
             self.mem[offset : offset + len(data)] = data
             return
         raise InvalidAddress("{} unhandled write at {}".format(self.name, hex(addr)))
 
+    def backing(self, addr):
+        sub = self.find(addr)
+        if sub is not None:
+            return sub.backing(addr)
+        if self.mem:
+            return self.mem, addr - self.base
+        return None, 0
+
+
+class MappedAddrSpace(BufferAddrSpace):
+    """
+    Plain memory on an anonymous mmap, host pages are only allocated when
+    the guest touches them.
+    """
+
+    def __init__(self, base, size, name=None) -> None:
+        super().__init__(base, size, name, False)
+        self.mem = memoryview(mmap.mmap(-1, size))
+
+
+class RegisterAddrSpace(AddrSpace):
+    """
+    A device as registers at offsets from base, declared by add_register.
+    An access is served by the register at its address alone, with one
+    callback. Offsets without a register read 0 and ignore writes.
+    """
+
+    def __init__(self, base, size, name=None) -> None:
+        super().__init__(base, size, name, False)
+        self._readers = {}  # {offset:(mask, read())}
+        self._writers = {}  # {offset:(mask, write(value))}
+
+    def add_register(self, offset, width, read=None, write=None):
+        """
+        width: bytes, values passed to write are cut to it
+        read: return the register value, write: take a new value
+        """
+        if offset < 0 or offset + width > self.end - self.base + 1:
+            raise ValueError("register {} outside {}".format(hex(offset), self.name))
+        mask = (1 << width * 8) - 1
+        if read is not None:
+            self._readers[offset] = (mask, read)
+        if write is not None:
+            self._writers[offset] = (mask, write)
+
+    def read(self, addr, length):
+        reg = self._readers.get(addr - self.base)
+        if reg is None:
+            return bytes(length)
+        mask, func = reg
+        return (func() & mask & ((1 << length * 8) - 1)).to_bytes(length, "little")
+
+    def write(self, addr, data):
+        reg = self._writers.get(addr - self.base)
+        if reg is not None:
+            mask, func = reg
+            func(int.from_bytes(data, "little") & mask)
+
 
 class ByteAddrSpace(AddrSpace):
 
@@ -1,8 +1,11 @@
 import collections
+import functools
 import logging
+import struct
+import threading
 import time
 
-from . import addrspace, decoder, util
+from . import addrspace, decoder
 
 logger = logging.getLogger(__name__)
 
@@ -12,8 +15,18 @@ MODE_M = 0b11
 
 INTERRUPT_TIMER_S = 0x80000005
 INTERRUPT_TIMER_M = 0x80000007
+INTERRUPT_EXTERNAL_S = 0x80000009
+INTERRUPT_EXTERNAL_M = 0x8000000B
 
+MIP_STIP = 1 << 5  # mip and mie bits
+MIP_MTIP = 1 << 7
+MIP_SEIP = 1 << 9
+MIP_MEIP = 1 << 11
+
+EXCEPTION_INST_ACCESS_FAULT = 1
 EXCEPTION_ILLEGAL_INSTRUCTION = 2
+EXCEPTION_LOAD_ACCESS_FAULT = 5
+EXCEPTION_STORE_AMO_ACCESS_FAULT = 7
 
 EXCEPTION_ECALL_FROM_U = 8
 EXCEPTION_ECALL_FROM_S = 9
@@ -23,58 +36,286 @@ EXCEPTION_INST_PAGE_FAULT = 12
 EXCEPTION_LOAD_PAGE_FAULT = 13
 EXCEPTION_STORE_AMO_PAGE_FAULT = 15
 
+X0_SINK = 32  # CPU.regs slot taking writes to x0, so x0 itself stays 0
+
+
+class Trap(Exception):
+    """
+    Aborts the current instruction on a synchronous exception. The one TRAP
+    instance is raised again for every fault, so no exception object is
+    built per trap: CPU.raise_trap leaves the cause in CPU.trap_cause and
+    CPU.trap_tval and CPU.run takes the trap at the block exit. run also
+    clears its context and traceback there, so the host exception a fault
+    was raised from and its frames are not kept alive.
+    """
+
 
-class GOTRAP(Exception):
-    pass
+TRAP = Trap()
 
 
 class CPU:
 
+    __slots__ = (
+        "pc",
+        "regs",
+        "mode",
+        "csr",
+        "skip_step",
+        "_timer_check",
+        "_csr_satp_changed",
+        "_csr_status_changed",
+        "_addrspace",
+        "_addrspace_nommu",
+        "_start_time",
+        "inst_cache",
+        "code_pages",
+        "code_lines",
+        "smc_writes",
+        "smc_blocks",
+        "decode_cache",
+        "_link_gen",
+        "_linked_vpns",
+        "block_sizes",
+        "fusions",
+        "clint_base",
+        "icount",
+        "icount_retired",
+        "wakeup",
+        "_calls",
+        "trap_cause",
+        "trap_tval",
+        "_translator",
+    )
+
     XLEN = 32
     XMASK = 0xFFFFFFFF
     TIMEBASE_FREQ = 1000000
 
     MTIME_OFFSET = 0xBFF8
     MTIMECMP_OFFSET = 0x4000
+    TIMER_CHECK = 2048  # max instructions between timer/interrupt checks
+    WFI_MAX_SLEEP = 1.0  # seconds, when no timer deadline is armed
+    # mtimecmp at or above it arms no deadline, Linux parks it at all-ones
+    MTIMECMP_DISARMED = 1 << 63
 
-    def __init__(self, _addrspace: addrspace.AddrSpace, clint_base) -> None:
+    def __init__(
+        self, _addrspace: addrspace.AddrSpace, clint_base, jit=False, icount=0
+    ) -> None:
         self.pc = 0
         self._csr_satp_changed = True
-        self.regs = REGS()
+        self._csr_status_changed = False  # mstatus.SUM or MXR written
+        # x0..x31 then X0_SINK, a plain list so reads and writes stay in C.
+        # Values are unsigned 32 bit, instructions mask where they overflow.
+        self.regs = [0] * (X0_SINK + 1)
         self.csr = CSR(self)
         self._addrspace_nommu = _addrspace
         self._addrspace = MMU(self, _addrspace)
         self.skip_step = 0
         self.mode = MODE_M
         self._start_time = time.monotonic_ns()
-        self.inst_cache = collections.defaultdict(dict)  # {ppn, {paddr:inst}}
+        self.inst_cache = {}  # {ppn, {paddr:Block}}, for pages in code_pages
+        # one flag per physical page holding blocks, Sv32 paddrs are 34 bit.
+        # Stores to flagged pages check for code, see TLB, and drop the
+        # blocks they overlap.
+        self.code_pages = bytearray(1 << 22)
+        # {ppn:mask of its 64 byte lines holding blocks}, for pages in
+        # code_pages. Stores to the other lines skip the block scan.
+        self.code_lines = {}
+        self.smc_writes = 0  # stores that dropped blocks
+        self.smc_blocks = 0  # blocks they dropped
+        self.decode_cache = decoder.DecodeCache()
+        self._link_gen = 0  # Block.exits are valid for this generation only
+        self._linked_vpns = set()  # pages of link targets in this generation
+        self.block_sizes = collections.Counter()  # {len(insts):built blocks}
+        # {(first, second) instruction name:fused in built blocks}
+        self.fusions = collections.Counter()
         self.clint_base = clint_base
+        # icount mode: mtime advances one tick every icount retired
+        # instructions instead of following the host clock
+        self.icount = icount
+        self.icount_retired = 0
+        self._timer_check = CPU.TIMER_CHECK
+        # set by devices with new input and by stop requests, ends a WFI sleep
+        self.wakeup = threading.Event()
+        self._calls = collections.deque()  # from other threads, see call_soon
+        self.trap_cause = 0  # pending synchronous trap, see Trap
+        self.trap_tval = 0
+        if jit:
+            from . import jit as _jit
+
+            self._translator = _jit.Translator(self)
+        else:
+            self._translator = None  # interpreter only
+
+    def invalidate_links(self):
+        """
+        Drop all block links, needed whenever a vaddr may translate to
+        another block: satp change, sfence.vma or a write to a code page.
+        """
+        self._link_gen += 1
+        self._linked_vpns.clear()
+
+    def invalidate_code(self, paddr, length):
+        """
+        Drop the blocks overlapping a write of length bytes at paddr. Called
+        for stores to code pages, DMA into guest memory calls it too.
+        """
+        end = paddr + length
+        dropped = 0
+        for ppn in range(paddr >> 12, ((end - 1) >> 12) + 1):
+            if not self.code_pages[ppn]:
+                continue
+            first = max(paddr, ppn << 12) >> 6 & 0x3F
+            last = (min(end, ppn + 1 << 12) - 1) >> 6 & 0x3F
+            if not self.code_lines[ppn] >> first & (2 << last - first) - 1:
+                continue
+            blocks = self.inst_cache[ppn]
+            stale = [
+                start
+                for start, block in blocks.items()
+                if start < end and paddr < start + len(block) * 4
+            ]
+            if not stale:
+                continue
+            for start in stale:
+                del blocks[start]
+            dropped += len(stale)
+            if blocks:
+                lines = 0
+                for block in blocks.values():
+                    lines |= block.lines()
+                self.code_lines[ppn] = lines
+            else:  # plain data again, stores may use the dtlb
+                del self.inst_cache[ppn]
+                del self.code_lines[ppn]
+                self.code_pages[ppn] = 0
+                self._addrspace.dtlb.unprotect(ppn)
+        if dropped:
+            self.smc_writes += 1
+            self.smc_blocks += dropped
+            self.invalidate_links()
+
+    def on_memory_map_change(self):
+        """TLBs hold host buffers of RAM pages, see addrspace.BufferAddrSpace"""
+        self._addrspace.itlb.clear()
+        self._addrspace.dtlb.clear()
+
+    def on_mtimecmp_write(self):
+        """
+        Re-check the timer after the current block, see peripheral.CLINT.
+        Called on the CPU thread, by the store to mtimecmp.
+        """
+        self._timer_check = self.skip_step
+
+    def on_external_interrupt(self, context, level):
+        """
+        PLIC context 0 drives mip.MEIP and context 1 mip.SEIP, taken after
+        the current block, see peripheral.PLIC. Called on the CPU thread,
+        device threads go through call_soon.
+        """
+        bit = MIP_MEIP if context == 0 else MIP_SEIP
+        if level:
+            self.csr.mip |= bit
+        else:
+            self.csr.mip &= ~bit
+        self._timer_check = self.skip_step
+
+    def call_soon(self, func):
+        """
+        Run func on the CPU thread after the current block, for device
+        threads whose input changes guest visible state. Only the deque and
+        the wakeup event are touched here, run() notices the call itself.
+        """
+        self._calls.append(func)
+        self.wakeup.set()
+
+    def _update_timer(self):
+        if self.icount:
+            self.icount_retired += self.skip_step
+            cur_time = self.icount_retired // self.icount
+        else:
+            cur_time = int(
+                (time.monotonic_ns() - self._start_time) * 1e-9 * CPU.TIMEBASE_FREQ
+            )
+        self._addrspace_nommu.u64[self.clint_base + CPU.MTIME_OFFSET] = cur_time
+        self.csr.time = cur_time & 0xFFFFFFFF
+        self.csr.timeh = cur_time >> 32
+        self.skip_step = 0
+        mtimecmp = self._addrspace_nommu.u64[self.clint_base + CPU.MTIMECMP_OFFSET]
+        if cur_time >= mtimecmp:
+            self.csr.mip |= MIP_MTIP
+        else:
+            self.csr.mip &= ~MIP_MTIP
+        self._timer_check = CPU.TIMER_CHECK
+        if self.icount and mtimecmp > cur_time:
+            # stop right at the instruction where mtime reaches mtimecmp
+            self._timer_check = min(
+                CPU.TIMER_CHECK, mtimecmp * self.icount - self.icount_retired
+            )
+
+    def wait_for_interrupt(self):
+        """
+        WFI: sleep until mtimecmp, device input or a stop request. In icount
+        mode virtual time skips forward to mtimecmp instead, by at most
+        WFI_MAX_SLEEP, when the timer interrupt is enabled and armed and no
+        input is pending; otherwise only device input can end the wait.
+        """
+        if self.csr.mip & self.csr.mie or self._calls:
+            return
+        mtimecmp = self._addrspace_nommu.u64[self.clint_base + CPU.MTIMECMP_OFFSET]
+        armed = self.csr.mie & MIP_MTIP and mtimecmp < CPU.MTIMECMP_DISARMED
+        if self.icount and armed:
+            if not self.wakeup.is_set():
+                now = self.icount_retired + self.skip_step
+                skip = min(
+                    mtimecmp * self.icount - now,
+                    int(CPU.WFI_MAX_SLEEP * CPU.TIMEBASE_FREQ) * self.icount,
+                )
+                self.icount_retired += max(0, skip)
+            self.wakeup.clear()
+        else:
+            timeout = CPU.WFI_MAX_SLEEP
+            if armed:
+                cur_time = (time.monotonic_ns() - self._start_time) * 1e-9
+                timeout = min(timeout, mtimecmp / CPU.TIMEBASE_FREQ - cur_time)
+            if timeout > 0:
+                self.wakeup.wait(timeout)
+            self.wakeup.clear()
+        self._timer_check = self.skip_step  # update mtime after this block
+
+    def raise_trap(self, cause, tval=0):
+        """Abort the current instruction, run() then takes the trap at self.pc"""
+        self.trap_cause = cause
+        self.trap_tval = tval
+        raise TRAP.with_traceback(None) from None
 
     def _go_mtrap(self, mcause, mtval=0):
         logger.debug(
             "go_mtrap, mode: {}, mcause {}".format(bin(self.mode), hex(mcause))
         )
-        self.csr.mcause = mcause
-        self.csr.mepc = self.pc
-        self.csr.mstatus.MPIE = self.csr.mstatus.MIE
-        self.csr.mstatus.MIE = 0
-        self.csr.mstatus.MPP = self.mode
+        csr = self.csr
+        csr.mcause = mcause
+        csr.mepc = self.pc
+        csr.mstatus_MPIE = csr.mstatus_MIE
+        csr.mstatus_MIE = 0
+        csr.mstatus_MPP = self.mode
         self.mode = MODE_M
-        self.csr.mtval = mtval
-        self.pc = self.csr.mtvec & 0xFFFFFFFC  # Only Direct Mode
+        csr.mtval = mtval
+        self.pc = csr.mtvec & 0xFFFFFFFC  # Only Direct Mode
 
     def _go_strap(self, scause, stval=0):
         logger.debug(
             "go_strap, mode: {}, scause {}".format(bin(self.mode), hex(scause))
         )
-        self.csr.scause = scause
-        self.csr.sepc = self.pc
-        self.csr.sstatus.SPIE = self.csr.sstatus.SIE
-        self.csr.sstatus.SIE = 0
-        self.csr.sstatus.SPP = self.mode
+        csr = self.csr
+        csr.scause = scause
+        csr.sepc = self.pc
+        csr.mstatus_SPIE = csr.mstatus_SIE
+        csr.mstatus_SIE = 0
+        csr.mstatus_SPP = self.mode
         self.mode = MODE_S
-        self.csr.stval = stval
-        self.pc = self.csr.stvec & 0xFFFFFFFC  # Only Direct Mode
+        csr.stval = stval
+        self.pc = csr.stvec & 0xFFFFFFFC  # Only Direct Mode
 
     def _go_trap(self, cause, tval=0):
         logger.debug(
@@ -83,128 +324,236 @@ class CPU:
             )
         )
         if cause >> 31:  # msb=1, interrupt
-            a = (MODE_M == self.mode and self.csr.mstatus.MIE) or MODE_M > self.mode
-            c = util.get_bit(self.csr.mideleg, cause & 0x7FFFFFFF)
+            a = (MODE_M == self.mode and self.csr.mstatus_MIE) or MODE_M > self.mode
+            c = self.csr.mideleg >> (cause & 0x7FFFFFFF) & 1
             if a and not c:
                 self._go_mtrap(cause, tval)
                 return True
-            a = (MODE_S == self.mode and self.csr.sstatus.SIE) or MODE_S > self.mode
+            a = (MODE_S == self.mode and self.csr.mstatus_SIE) or MODE_S > self.mode
             if a and c:
                 self._go_strap(cause, tval)
                 return True
             logger.debug(
                 "interrupt {} not handled, mode={}, MIE={}, SIE={}".format(
-                    cause, self.mode, self.csr.mstatus.MIE, self.csr.sstatus.SIE
+                    cause, self.mode, self.csr.mstatus_MIE, self.csr.mstatus_SIE
                 )
             )
             return False
         else:  # exception
-            if MODE_M > self.mode and util.get_bit(
-                self.csr.medeleg, cause
-            ):  # not support medelegh
+            if MODE_M > self.mode and self.csr.medeleg >> cause & 1:
+                # not support medelegh
                 self._go_strap(cause, tval)
             else:
                 self._go_mtrap(cause, tval)
         return True
 
     def run(self, step):
+        from . import fusion
         from .inst import MayJumpInst
 
         prev_mode = -1
+        prev_block = None
         while step > 0:
             # logger.debug(self.regs)
             # logger.debug(self.csr)
-            if self._csr_satp_changed or prev_mode != self.mode:
-                self._addrspace.accel_cache.clear()
+            if (
+                self._csr_satp_changed
+                or self._csr_status_changed
+                or prev_mode != self.mode
+            ):
+                self._addrspace.update_context()
+                if self._csr_satp_changed:
+                    self.invalidate_links()
                 self._csr_satp_changed = False
+                self._csr_status_changed = False
                 prev_mode = self.mode
             # exec inst
             cached_pc = self.pc
-            try:
-                paddr = self._addrspace.translate_addr_accel(
-                    2, cached_pc, fetch_inst=True
-                )
-                insts = self.inst_cache[paddr >> 12].get(paddr)
-                if not insts:
-                    pc_paddr = paddr
-                    insts = []
-                    while True:
-                        decoded_inst = decoder.decode(
-                            self._addrspace_nommu.u32[pc_paddr]
-                        )
-                        insts.append(decoded_inst)
-                        pc_paddr += 4
-                        if pc_paddr ^ paddr > 0xFFF or isinstance(
-                            decoded_inst, MayJumpInst
-                        ):
-                            break
-                        # if self._csr_satp_changed or prev_mode != self.mode:
-                        #     break
-                    self.inst_cache[paddr >> 12][paddr] = insts
-            except MMU.PageFaultException as e:
-                self._go_trap(EXCEPTION_INST_PAGE_FAULT, e.vaddr)
-                continue
+            block = None
+            if (
+                prev_block is not None
+                and prev_block.link_gen == self._link_gen
+                and prev_block.link_mode == prev_mode
+            ):
+                block = prev_block.exits.get(cached_pc)
+            if block is None:
+                try:
+                    paddr = self._addrspace.translate_fetch(cached_pc)
+                    page = self.inst_cache.get(paddr >> 12)
+                    block = page.get(paddr) if page else None
+                    if not block:
+                        pc_paddr = paddr
+                        insts = []
+                        while True:
+                            try:
+                                word = self._addrspace_nommu.u32[pc_paddr]
+                            except addrspace.InvalidAddress:
+                                if not insts:
+                                    self.raise_trap(
+                                        EXCEPTION_INST_ACCESS_FAULT, cached_pc
+                                    )
+                                break  # the block runs up to the fault
+                            try:
+                                decoded_inst = self.decode_cache.decode(word)
+                            except RuntimeError:
+                                if not insts:
+                                    raise
+                                break  # data behind a not taken branch
+                            insts.append(decoded_inst)
+                            pc_paddr += 4
+                            if pc_paddr ^ paddr > 0xFFF or (
+                                isinstance(decoded_inst, MayJumpInst)
+                                and decoded_inst.ends_block
+                            ):
+                                break
+                            # if self._csr_satp_changed or prev_mode != self.mode:
+                            #     break
+                        block = Block(paddr, insts)
+                        self.block_sizes[len(insts)] += 1
+                        if self._translator:
+                            block.func = self._translator.translate(insts)
+                        else:
+                            block.ops = fusion.fuse(insts, self.fusions)
+                        if not page:  # stores to it now check for code
+                            page = self.inst_cache[paddr >> 12] = {}
+                            self.code_pages[paddr >> 12] = 1
+                            self.code_lines[paddr >> 12] = 0
+                            self._addrspace.dtlb.protect(paddr >> 12)
+                        page[paddr] = block
+                        self.code_lines[paddr >> 12] |= block.lines()
+                except Trap:
+                    TRAP.__context__ = TRAP.__traceback__ = None
+                    self._go_trap(self.trap_cause, self.trap_tval)
+                    continue
+                if prev_block is not None:
+                    prev_block.link(cached_pc, block, self._link_gen, prev_mode)
+                    self._linked_vpns.add(cached_pc >> 12)
+            prev_block = block
 
             # logger.debug(insts)
+            insts = block.ops
+            func = block.func
+            if self.icount and len(block) > self._timer_check - self.skip_step:
+                # interpret up to the timer deadline, so it fires exactly
+                insts = block.insts[: max(1, self._timer_check - self.skip_step)]
+                func = None
             try:
-                for inst in insts:
-                    cached_pc = self.pc
-                    inst.exec(self)
-                    if cached_pc == self.pc:
-                        self.pc += 4  # IS THIS RIGHT?
-            except GOTRAP:
-                continue
-            except MMU.PageFaultException as e:
-                if isinstance(e, MMU.LoadPageFault):
-                    cause = EXCEPTION_LOAD_PAGE_FAULT
+                if func:
+                    inst_cnt = func(self)
                 else:
-                    cause = EXCEPTION_STORE_AMO_PAGE_FAULT
-                self._go_trap(cause, e.vaddr)
+                    inst_cnt = 0  # in bytes, a fused op is two instructions
+                    for inst in insts:
+                        inst_cnt += inst.length
+                        cached_pc = self.pc
+                        inst.exec(self)
+                        if cached_pc == self.pc:
+                            self.pc += inst.length  # IS THIS RIGHT?
+                        else:  # taken branch, side exit
+                            break
+                    inst_cnt >>= 2
+            except Trap:
+                TRAP.__context__ = TRAP.__traceback__ = None
+                self._go_trap(self.trap_cause, self.trap_tval)
                 continue
 
             # step is not accurate
-            inst_cnt = len(insts)
             self.skip_step += inst_cnt
             step -= inst_cnt
 
-            if self.skip_step > 2048:
-                # mtime
-                cur_time = int(
-                    (time.monotonic_ns() - self._start_time) * 1e-9 * CPU.TIMEBASE_FREQ
-                )
-                self._addrspace_nommu.u64[self.clint_base + CPU.MTIME_OFFSET] = cur_time
-                self.csr.time = cur_time & 0xFFFFFFFF
-                self.csr.timeh = cur_time >> 32
-                self.skip_step = 0
-                mtime_pend = (
-                    1
-                    if cur_time
-                    >= self._addrspace_nommu.u64[self.clint_base + CPU.MTIMECMP_OFFSET]
-                    else 0
-                )
-                self.csr.mip.MTIP = mtime_pend
+            if self._calls:
+                while self._calls:
+                    self._calls.popleft()()
+                self._timer_check = self.skip_step
 
-                # check interrupt
-                if self.csr.mip.MTIP and self.csr.mie.MTIE:  # MTIMER
-                    if self._go_trap(INTERRUPT_TIMER_M):
-                        continue
+            if self.skip_step >= self._timer_check:
+                self._update_timer()
 
-                if self.csr.sip.STIP and self.csr.sie.STIE:  # STIMER
-                    if self._go_trap(INTERRUPT_TIMER_S):
-                        continue
+                # check interrupt, in priority order
+                pending = self.csr.mip & self.csr.mie
+                if pending:
+                    if pending & MIP_MEIP:  # MEXTERNAL
+                        if self._go_trap(INTERRUPT_EXTERNAL_M):
+                            continue
+                    if pending & MIP_MTIP:  # MTIMER
+                        if self._go_trap(INTERRUPT_TIMER_M):
+                            continue
+                    if pending & MIP_SEIP:  # SEXTERNAL
+                        if self._go_trap(INTERRUPT_EXTERNAL_S):
+                            continue
+                    if pending & MIP_STIP:  # STIMER
+                        if self._go_trap(INTERRUPT_TIMER_S):
+                            continue
 
 
-class REGS(list):
+class Block:
+    """
+    A run of decoded instructions starting at paddr, as built by CPU.run.
+    It ends at a jump, a CSR write that may change translation or the page
+    edge, and runs through conditional branches: a taken one leaves early.
+    func is the translated python function returning the number of executed
+    instructions, None when interpreting. ops is what the interpreter runs:
+    insts with some pairs fused, see fusion.fuse.
 
-    def __init__(self) -> None:
-        super().__init__([0] * 32)
+    exits links the pc reached after this block to the next block, so hot
+    paths skip address translation and inst_cache lookups. Branches give
+    taken and fall-through exits, a JALR block collects up to MAX_EXITS
+    indirect targets. Links belong to one (link_gen, mode).
+    """
 
-    def __setitem__(self, key, value):
-        if key:
-            super().__setitem__(key, value & 0xFFFFFFFF)
+    __slots__ = ("paddr", "insts", "ops", "func", "exits", "link_gen", "link_mode")
+
+    MAX_EXITS = 16
 
+    def __init__(self, paddr, insts, func=None) -> None:
+        self.paddr = paddr
+        self.insts = insts
+        self.ops = insts
+        self.func = func
+        self.exits = {}  # {vaddr:Block}
+        self.link_gen = -1
+        self.link_mode = -1
 
-class CSR(util.NamedArray):
+    def link(self, pc, block, link_gen, mode):
+        if (
+            self.link_gen != link_gen
+            or self.link_mode != mode
+            or len(self.exits) >= Block.MAX_EXITS
+        ):
+            self.exits = {}
+            self.link_gen = link_gen
+            self.link_mode = mode
+        self.exits[pc] = block
+
+    def __len__(self):
+        return len(self.insts)
+
+    def lines(self):
+        """mask of the 64 byte lines of its page the block covers"""
+        first = self.paddr >> 6 & 0x3F
+        last = (self.paddr + len(self.insts) * 4 - 1) >> 6 & 0x3F
+        return (2 << last) - (1 << first)
+
+    def __repr__(self) -> str:
+        return "Block[paddr:{:#x}, len:{}, jit:{}, exits:{}]".format(
+            self.paddr,
+            len(self.insts),
+            self.func is not None,
+            [hex(x) for x in self.exits],
+        )
+
+
+class CSR:
+    """
+    Control and status registers, csr[number] for the CSR instructions.
+
+    The read and write handler of every implemented CSR is picked once, in
+    __init__; the others trap as illegal instructions. Registers are plain
+    int attributes named as in ADDR_MAP. mstatus is kept as its fields,
+    mstatus_<FIELD> ints, so trap entry and return are a few attribute
+    stores. mie and mip are bitmasks, pending interrupts are mip & mie.
+    sstatus, sie and sip are views of the machine registers. mip.MEIP and
+    SEIP follow the PLIC, writes leave them alone.
+    """
 
     ADDR_MAP = {
         "time": 0xC01,
@@ -236,236 +585,489 @@ class CSR(util.NamedArray):
         "mcause": 0x342,
         "mtval": 0x343,
         "mip": 0x344,
-        "mhartid": 0xF14,
-    }
-
-    MSTATUS_BITMAP = {
-        "SIE": (1, 1, 0),
-        "MIE": (3, 3, 0),
-        "SPIE": (5, 5, 0),
-        "MPIE": (7, 7, 0),
-        "SPP": (8, 8, 0),
-        "MPP": (11, 12, 0b11),
-        "SUM": (18, 18, 0),
-        "MXR": (19, 19, 0),
     }
 
-    MIE_BITMAP = {"STIE": (5, 5, 0), "MTIE": (7, 7, 0)}
-
-    MIP_BITMAP = {"STIP": (5, 5, 0), "MTIP": (7, 7, 0)}
+    ALIASES = {"sstatus": "mstatus", "sie": "mie", "sip": "mip"}
 
-    SATP_BITMAP = {"PPN": (0, 21, 0), "ASID": (22, 30, 0), "MODE": (31, 31, 0)}
+    # mstatus bits kept as fields, the others are stored as written
+    MSTATUS_FIELDS = 1 << 1 | 1 << 3 | 1 << 5 | 1 << 7 | 1 << 8 | 3 << 11 | 3 << 18
 
     def __init__(self, _cpu: CPU) -> None:
-        init_array = [
-            0 if idx in CSR.ADDR_MAP.values() else None for idx in range(4096)
-        ]
-        super().__init__(init_array, CSR.ADDR_MAP)
         self._cpu = _cpu
-        self.mstatus = self.sstatus = util.bit_container(
-            "[m/s]status", CSR.MSTATUS_BITMAP
-        )()
-        self.mie = self.sie = util.bit_container("[m/s]ie", CSR.MIE_BITMAP)()
-        self.mip = self.sip = util.bit_container("[m/s]ip", CSR.MIP_BITMAP)()
-        self.satp = util.bit_container("satp", CSR.SATP_BITMAP)()
+        self.mstatus_SUM = self.mstatus_MXR = 0
+        for name in CSR.ADDR_MAP:
+            if name not in CSR.ALIASES:
+                setattr(self, name, 0)
         self.misa = 0x40141101  # rv32ima S/U mode
-        self._satp_mode = 0
-        self._satp_asid = 0
+        self.mstatus = MODE_M << 11  # MPP
+        self._readers = [None] * 4096  # [csr number] -> () -> value
+        self._writers = [None] * 4096  # [csr number] -> (value) -> None
+        for name, key in CSR.ADDR_MAP.items():
+            name = CSR.ALIASES.get(name, name)
+            self._readers[key] = functools.partial(getattr, self, name)
+            self._writers[key] = functools.partial(setattr, self, name)
+        self._writers[CSR.ADDR_MAP["mip"]] = self._write_mip
+        self._writers[CSR.ADDR_MAP["sip"]] = self._write_mip
+
+    def _write_mip(self, value):
+        external = MIP_MEIP | MIP_SEIP
+        self.mip = value & ~external | self.mip & external
+
+    @property
+    def mstatus(self):
+        return (
+            self._mstatus_other
+            | self.mstatus_SIE << 1
+            | self.mstatus_MIE << 3
+            | self.mstatus_SPIE << 5
+            | self.mstatus_MPIE << 7
+            | self.mstatus_SPP << 8
+            | self.mstatus_MPP << 11
+            | self.mstatus_SUM << 18
+            | self.mstatus_MXR << 19
+        )
+
+    @mstatus.setter
+    def mstatus(self, value):
+        self._mstatus_other = value & ~CSR.MSTATUS_FIELDS
+        self.mstatus_SIE = value >> 1 & 1
+        self.mstatus_MIE = value >> 3 & 1
+        self.mstatus_SPIE = value >> 5 & 1
+        self.mstatus_MPIE = value >> 7 & 1
+        self.mstatus_SPP = value >> 8 & 1
+        self.mstatus_MPP = value >> 11 & 3
+        if value >> 18 & 3 != self.mstatus_SUM | self.mstatus_MXR << 1:
+            self.mstatus_SUM = value >> 18 & 1
+            self.mstatus_MXR = value >> 19 & 1
+            self._cpu._csr_status_changed = True  # MMU permission context
+
+    @property
+    def satp(self):
+        return self._satp
+
+    @satp.setter
+    def satp(self, value):
+        self._satp = value
+        # the MMU reads these on every translation
+        self._satp_mode = value >> 31
+        self._satp_asid = value >> 22 & 0x1FF
+        self._satp_ppn = value & 0x3FFFFF
+        self._cpu._csr_satp_changed = True
 
     def __getitem__(self, key):
-        value = self._inner_array[key]
-        if value is None:
-            self._cpu._go_trap(EXCEPTION_ILLEGAL_INSTRUCTION, self._cpu.pc)
-            raise GOTRAP()
-        return int(value)
+        read = self._readers[key]
+        if read is None:
+            self._cpu.raise_trap(EXCEPTION_ILLEGAL_INSTRUCTION, self._cpu.pc)
+        return read()
 
     def __setitem__(self, key, value):
-        value_old = self._inner_array[key]
-        if value_old is None:
-            self._cpu._go_trap(EXCEPTION_ILLEGAL_INSTRUCTION, self._cpu.pc)
-            raise GOTRAP()
-        if type(value_old) == int:
-            self._inner_array[key] = value
-        else:  # bit_container
-            value_old._value = value
-            if 0x180 == key:  # satp
-                self._cpu._csr_satp_changed = True
-                # access ASID from satp is slow, cache it
-                self._satp_mode = self.satp.MODE
-                self._satp_asid = self.satp.ASID
+        write = self._writers[key]
+        if write is None:
+            self._cpu.raise_trap(EXCEPTION_ILLEGAL_INSTRUCTION, self._cpu.pc)
+        write(value)
 
     def __repr__(self) -> str:
         return (
             self.__class__.__name__
             + ": "
-            + "[{}]".format(", ".join(hex(int(x)) for x in self._inner_array))
+            + "[{}]".format(
+                ", ".join(
+                    "{}={}".format(name, hex(self[key]))
+                    for name, key in CSR.ADDR_MAP.items()
+                )
+            )
         )
 
 
-class MMU(addrspace.AddrSpace):
+class TLB:
+    """
+    Direct mapped software TLB of 4 KiB pages. Slot (vpn ^ vpn >> 10) & mask
+    holds one page, the fold keeps pages 4 MiB apart out of each other's
+    slot. tags[slot] is vpn | MMU.context and the page translates as
+    paddr = vaddr + deltas[slot]. wtags[slot] repeats the tag when stores
+    may use the slot too, and is -1 while the page is clean, read only or
+    in CPU.code_pages, so such stores go through MMU.write. A writable page
+    in CPU.code_pages has its tag in ctags[slot] instead: stores skip the
+    walk but still check for code.
+    A page of plain memory also keeps its host buffer: mems[slot] and
+    index = vaddr + hosts[slot]. mems[slot] is None for device pages.
+    """
+
+    SIZE = 1024
+
+    def __init__(self, size=SIZE) -> None:
+        self.mask = size - 1
+        self.tags = [-1] * size
+        self.wtags = [-1] * size
+        self.ctags = [-1] * size
+        self.deltas = [0] * size
+        self.mems = [None] * size
+        self.hosts = [0] * size
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+
+    def fill(
+        self, vaddr, paddr, context, writable=False, mem=None, index=0, code=False
+    ):
+        vpn = vaddr >> 12
+        slot = (vpn ^ vpn >> 10) & self.mask
+        self.tags[slot] = vpn | context
+        self.wtags[slot] = vpn | context if writable and not code else -1
+        self.ctags[slot] = vpn | context if writable and code else -1
+        self.deltas[slot] = (paddr >> 12) - vpn << 12
+        self.mems[slot] = mem
+        self.hosts[slot] = index - vaddr
+        self.misses += 1
+
+    def flush(self, asid=None, vaddr=None):
+        """drop translated pages: all, those of asid, or the one of vaddr"""
+        self.flushes += 1
+        if vaddr is not None:
+            vpn = vaddr >> 12
+            slot = (vpn ^ vpn >> 10) & self.mask
+            tag = self.tags[slot]
+            if (
+                tag & MMU.CONTEXT_TRANSLATED
+                and tag & 0xFFFFF == vpn
+                and (asid is None or tag >> 20 & 0x1FF == asid)
+            ):
+                self.tags[slot] = self.wtags[slot] = self.ctags[slot] = -1
+            return
+        for slot, tag in enumerate(self.tags):
+            if tag & MMU.CONTEXT_TRANSLATED and (
+                asid is None or tag >> 20 & 0x1FF == asid
+            ):
+                self.tags[slot] = self.wtags[slot] = self.ctags[slot] = -1
 
-    class PageFaultException(Exception):
+    def clear(self):
+        """drop all pages, bare ones too"""
+        self.flushes += 1
+        for slot in range(self.mask + 1):
+            self.tags[slot] = self.wtags[slot] = self.ctags[slot] = -1
+
+    def protect(self, ppn):
+        """stores to physical page ppn must check for code again"""
+        for slot, tag in enumerate(self.wtags):
+            if tag != -1 and (tag & 0xFFFFF) + (self.deltas[slot] >> 12) == ppn:
+                self.ctags[slot] = tag
+                self.wtags[slot] = -1
+
+    def unprotect(self, ppn):
+        """physical page ppn holds no code any more, undo protect"""
+        for slot, tag in enumerate(self.ctags):
+            if tag != -1 and (tag & 0xFFFFF) + (self.deltas[slot] >> 12) == ppn:
+                self.wtags[slot] = tag
+                self.ctags[slot] = -1
+
+    def __repr__(self) -> str:
+        return "TLB[size:{}, hits:{}, misses:{}, flushes:{}]".format(
+            self.mask + 1, self.hits, self.misses, self.flushes
+        )
+
+
+class MMUWrap:
+    """
+    Typed access through the MMU, mmu.u32[vaddr] over phys, the ByteWrap of
+    the same type of the physical space. A dtlb hit on a memory page is one
+    struct call on the host buffer, device pages and misses use phys.
+    Accesses outside memory and devices, or running past their end, raise
+    access faults.
+    """
+
+    __slots__ = ("_mmu", "_tlb", "_size", "_unpack", "_pack", "_phys")
+
+    def __init__(self, mmu, phys) -> None:
+        self._mmu = mmu
+        self._tlb = mmu.dtlb
+        self._size = phys.struct.size
+        self._unpack = phys.struct.unpack_from
+        self._pack = phys.struct.pack_into
+        self._phys = phys
+
+    def __getitem__(self, addr):
+        tlb = self._tlb
+        vpn = addr >> 12
+        slot = (vpn ^ vpn >> 10) & tlb.mask
+        try:
+            if tlb.tags[slot] == vpn | self._mmu.context:
+                tlb.hits += 1
+                mem = tlb.mems[slot]
+                if mem is not None:
+                    return self._unpack(mem, addr + tlb.hosts[slot])[0]
+                return self._phys[addr + tlb.deltas[slot]]
+            return self._phys[self._mmu.translate_addr(addr)]
+        except (struct.error, addrspace.InvalidAddress):
+            self._mmu._cpu.raise_trap(EXCEPTION_LOAD_ACCESS_FAULT, addr)
+
+    def __setitem__(self, addr, value):
+        tlb = self._tlb
+        vpn = addr >> 12
+        slot = (vpn ^ vpn >> 10) & tlb.mask
+        try:
+            if tlb.wtags[slot] == vpn | self._mmu.context:
+                tlb.hits += 1
+                mem = tlb.mems[slot]
+                if mem is not None:
+                    self._pack(mem, addr + tlb.hosts[slot], value)
+                else:
+                    self._phys[addr + tlb.deltas[slot]] = value
+                return
+            mmu = self._mmu
+            if tlb.ctags[slot] == vpn | mmu.context:
+                tlb.hits += 1
+                paddr = addr + tlb.deltas[slot]
+            else:
+                paddr = mmu.translate_addr(addr, write=True)
+            if mmu._cpu.code_pages[paddr >> 12]:
+                mmu._cpu.invalidate_code(paddr, self._size)
+            self._phys[paddr] = value
+        except (struct.error, addrspace.InvalidAddress):
+            self._mmu._cpu.raise_trap(EXCEPTION_STORE_AMO_ACCESS_FAULT, addr)
 
-        def __init__(self, vaddr, *args: object) -> None:
-            super().__init__(*args)
-            self.vaddr = vaddr
 
-    class LoadPageFault(PageFaultException):
-        pass
+class MMU(addrspace.AddrSpace):
+    """
+    Sv32 translation through an instruction TLB and a data TLB. TLB tags
+    carry the privilege mode, whether satp translates and the ASID, see
+    update_context, so neither a mode switch nor a satp write flushes them.
 
-    class StorePageFault(PageFaultException):
-        pass
+    Permissions are checked when a TLB slot is filled: a dtlb tag allows
+    loads, a write tag stores and an itlb tag fetches. Data tags also carry
+    mstatus.SUM and MXR, the state the check was made in, so toggling them
+    selects other slots instead of flushing any.
+    """
 
     PAGE_SIZE = 4096
     PTE_SIZE = 4
+    WALK_CACHE_SIZE = 4096
 
-    PTE_BITMAP = {
-        "V": (0, 0, 0),
-        "R": (1, 1, 0),
-        "W": (2, 2, 0),
-        "X": (3, 3, 0),
-        "U": (4, 4, 0),
-        "G": (5, 5, 0),
-        "A": (6, 6, 0),
-        "D": (7, 7, 0),
-        "RSW": (8, 9, 0),
-        "PPN0": (10, 19, 0),
-        "PPN1": (20, 31, 0),
-    }
-    VA = util.bit_container(
-        "VA", {"VPN1": (22, 31, 0), "VPN0": (12, 21, 0), "OFFSET": (0, 11, 0)}
-    )
-    PA = util.bit_container(
-        "PA", {"PPN1": (22, 33, 0), "PPN0": (12, 21, 0), "OFFSET": (0, 11, 0)}
-    )
-    PTE = util.bit_container("PTE", PTE_BITMAP)
+    PTE_V = 1 << 0
+    PTE_R = 1 << 1
+    PTE_W = 1 << 2
+    PTE_X = 1 << 3
+    PTE_U = 1 << 4
+    PTE_G = 1 << 5
+    PTE_A = 1 << 6
+    PTE_D = 1 << 7
+
+    # tag bits above the vpn: mode 33:32, translated, SUM, MXR, asid 28:20
+    CONTEXT_TRANSLATED = 1 << 31
+    CONTEXT_SUM = 1 << 30
+    CONTEXT_MXR = 1 << 29
 
     def __init__(self, _cpu: CPU, _addrspace: addrspace.AddrSpace) -> None:
         super().__init__(0, 0xFFFFFFFF, self.__class__.__name__, False)
         self._cpu = _cpu
         self._addrspace = _addrspace
-        self.pte_cache = collections.defaultdict(
-            dict
-        )  # {asid:{vaddr&0xFFFFF000:(pte, pte_addr, superpage)}}
-        self.pa_cache = dict()  # {(pte, superpage, vaddr):pa}
-        self.accel_cache = dict()  # {tag:(prev_addr, prev_paddr)}
+        self.itlb = TLB()
+        self.dtlb = TLB()
+        # {root ppn << 10 | vpn1:paddr of the level 0 table}, non-leaf ptes
+        self.walk_cache = {}
+        self.walk_roots = set()  # root ppns that have walk_cache entries
+        self.walks = 0
+        self.walk_cache_hits = 0
+        self.superpages = set()  # vaddr >> 22 of superpages in the TLBs
+        self.context = MODE_M << 32  # of loads and stores
+        self.icontext = MODE_M << 32  # of fetches
+        self.s8 = MMUWrap(self, _addrspace.s8)
+        self.u8 = MMUWrap(self, _addrspace.u8)
+        self.s16 = MMUWrap(self, _addrspace.s16)
+        self.u16 = MMUWrap(self, _addrspace.u16)
+        self.s32 = MMUWrap(self, _addrspace.s32)
+        self.u32 = MMUWrap(self, _addrspace.u32)
+        self.s64 = MMUWrap(self, _addrspace.s64)
+        self.u64 = MMUWrap(self, _addrspace.u64)
+
+    def update_context(self):
+        """
+        recompute the TLB tag bits, after a mode switch or a write to satp,
+        mstatus.SUM or mstatus.MXR
+        """
+        mode = self._cpu.mode
+        csr = self._cpu.csr
+        if MODE_M == mode or not csr._satp_mode:
+            self.context = self.icontext = mode << 32
+            return
+        self.icontext = mode << 32 | MMU.CONTEXT_TRANSLATED | csr._satp_asid << 20
+        self.context = self.icontext
+        if MODE_S == mode and csr.mstatus_SUM:
+            self.context |= MMU.CONTEXT_SUM
+        if csr.mstatus_MXR:
+            self.context |= MMU.CONTEXT_MXR
+
+    def flush(self, asid=None, vaddr=None):
+        """
+        sfence.vma: vaddr flushes the entries of one page and its walk_cache
+        entries in every cached page table, a full or per asid flush drops
+        all of walk_cache. Block links only go when one of them may lead
+        into a flushed page.
+
+        A per asid flush is deliberately conservative: TLB tags do not keep
+        PTE_G, so global mappings cached under that asid go too, and
+        walk_cache is keyed by root, not asid, so other roots are dropped
+        as well. Both only cost refills.
+        """
+        if vaddr is not None and vaddr >> 22 in self.superpages:
+            vaddr = None  # its 4 KiB slots are not found from one vaddr
+        self.itlb.flush(asid, vaddr)
+        self.dtlb.flush(asid, vaddr)
+        if vaddr is None:
+            if asid is None:
+                self.superpages.clear()
+            self.walk_cache.clear()
+            self.walk_roots.clear()
+            self._cpu.invalidate_links()
+        else:
+            for root in self.walk_roots:
+                self.walk_cache.pop(root << 10 | vaddr >> 22, None)
+            if vaddr >> 12 in self._cpu._linked_vpns:
+                self._cpu.invalidate_links()
 
     def find_pte(self, addr):
-        asid = self._cpu.csr._satp_asid
-        key = addr & 0xFFFFF000
-        p = self.pte_cache[asid].get(key, None)
-        if p:
-            return p
+        """
+        Walk the page table, the level 1 step through walk_cache.
+        return (pte, pte_addr, superpage), pte None if addr is not mapped
+        """
         result_error = (None, None, False)
-        va = MMU.VA(addr)
-        pte_addr = self._cpu.csr.satp.PPN * MMU.PAGE_SIZE + va.VPN1 * MMU.PTE_SIZE
-        pte = MMU.PTE(self._addrspace.u32[pte_addr])
-        if not pte.V or (1 == pte.W and 0 == pte.R):
-            return result_error  # page fault
-        if not (pte.R or pte.X):  # next level
-            if pte.W + pte.R + pte.X:  # should not happen
+        self.walks += 1
+        root = self._cpu.csr._satp_ppn
+        key = root << 10 | addr >> 22
+        table = self.walk_cache.get(key)
+        if table is None:
+            pte_addr = root * MMU.PAGE_SIZE + (addr >> 22) * MMU.PTE_SIZE
+            pte = self._addrspace.u32[pte_addr]
+            if not pte & MMU.PTE_V or pte & (MMU.PTE_W | MMU.PTE_R) == MMU.PTE_W:
+                return result_error  # page fault
+            if pte & (MMU.PTE_R | MMU.PTE_X):
+                return pte, pte_addr, True  # superpage
+            if pte & MMU.PTE_W:  # should not happen
                 logger.error(
                     "PTE({}) at addr {} error: non-leaf pte RWX != 0".format(
-                        pte, pte_addr
+                        hex(pte), hex(pte_addr)
                     )
                 )
-            pte_addr = (
-                pte.PPN1 << 10 | pte.PPN0
-            ) * MMU.PAGE_SIZE + va.VPN0 * MMU.PTE_SIZE
-            pte = MMU.PTE(self._addrspace.u32[pte_addr])
-            if not pte.V or (1 == pte.W and 0 == pte.R) or not (pte.R or pte.X):
-                return result_error
-            superpage = False
+            table = (pte >> 10) * MMU.PAGE_SIZE
+            if len(self.walk_cache) >= MMU.WALK_CACHE_SIZE:
+                del self.walk_cache[next(iter(self.walk_cache))]
+            self.walk_cache[key] = table
+            self.walk_roots.add(root)
         else:
-            superpage = True
-
-        result_ok = (pte, pte_addr, superpage)
-        self.pte_cache[asid][key] = result_ok
-        return result_ok
+            self.walk_cache_hits += 1
+        pte_addr = table + (addr >> 12 & 0x3FF) * MMU.PTE_SIZE
+        pte = self._addrspace.u32[pte_addr]
+        if (
+            not pte & MMU.PTE_V
+            or pte & (MMU.PTE_W | MMU.PTE_R) == MMU.PTE_W
+            or not pte & (MMU.PTE_R | MMU.PTE_X)
+        ):
+            return result_error
+        return pte, pte_addr, False
 
     def translate_addr(self, addr, write=False, fetch_inst=False):
+        """
+        Translate on a TLB miss and fill the TLB after the permission check.
+        return paddr
+        """
         if self._cpu.csr._satp_mode and MODE_M != self._cpu.mode:
-            pte, pte_addr, superpage = self.find_pte(addr)
+            try:
+                pte, pte_addr, superpage = self.find_pte(addr)
+            except addrspace.InvalidAddress:  # page table outside memory
+                if fetch_inst:
+                    cause = EXCEPTION_INST_ACCESS_FAULT
+                elif write:
+                    cause = EXCEPTION_STORE_AMO_ACCESS_FAULT
+                else:
+                    cause = EXCEPTION_LOAD_ACCESS_FAULT
+                self._cpu.raise_trap(cause, addr)
+            if pte and not self.allows(pte, superpage, write, fetch_inst):
+                pte = None
+            if not pte:
+                if fetch_inst:
+                    cause = EXCEPTION_INST_PAGE_FAULT
+                elif write:
+                    cause = EXCEPTION_STORE_AMO_PAGE_FAULT
+                else:
+                    cause = EXCEPTION_LOAD_PAGE_FAULT
+                self._cpu.raise_trap(cause, addr)
 
-            if not pte or (write and not pte.W):
-                pagefault = (
-                    MMU.StorePageFault(addr) if write else MMU.LoadPageFault(addr)
-                )
-                raise pagefault
-
-            #### Omit permission check, for performance ####
-            # if MODE_U == self._cpu.mode and not pte.U:
-            #     logger.debug('PTE({}) at addr {} error: U mode without U flag'.format(pte, pte_addr))
-            #     raise pagefault
-            # if MODE_S == self._cpu.mode and pte.U and not self._cpu.csr.sstatus.SUM:
-            #     logger.debug('PTE({}) at addr {} error: S mode without SUM flag'.format(pte, pte_addr))
-            #     raise pagefault
-            # if not self._cpu.csr.sstatus.MXR and not pte.R:
-            #     logger.debug('PTE({}) at addr {} error: MXR=0, pte.R=0'.format(pte, pte_addr))
-            #     raise pagefault
-            # if superpage and pte.PPN0:
-            #     logger.debug('PTE({}) at addr {} error: MISALIGN superpage'.format(pte, pte_addr))
-            #     raise pagefault
-            # if fetch_inst:
-            #     if not pte.X:
-            #         logger.debug('PTE({}) at addr {} error: NO exec perm'.format(pte, pte_addr))
-            #         raise pagefault
-            # else:
-            #     if not pte.R:
-            #         logger.debug('PTE({}) at addr {} error: NO read perm'.format(pte, pte_addr))
-            #         raise pagefault
-
-            if (write and 0 == pte.D) or 0 == pte.A:
+            if (write and not pte & MMU.PTE_D) or not pte & MMU.PTE_A:
                 # logger.debug('PTE({}) at addr {} error: A/D flag not valid, do repare'.format(pte, pte_addr))
-                pte.A = 1
+                pte |= MMU.PTE_A
                 if write:
-                    pte.D = 1
-                self._addrspace.u32[pte_addr] = int(pte)  # NEED UPDATE PTE CACHE
-                self.pte_cache[self._cpu.csr._satp_asid][addr & 0xFFFFF000] = (
-                    pte,
-                    pte_addr,
-                    superpage,
-                )
-            pa_key = (int(pte) & 0xFFFFFC00, superpage, addr)
-            paddr = self.pa_cache.get(pa_key)
-            if not paddr:
-                va = MMU.VA(addr)
-                pa = MMU.PA(0)
-                pa.OFFSET = va.OFFSET
-                pa.PPN0 = va.VPN0 if superpage else pte.PPN0
-                pa.PPN1 = pte.PPN1
-                paddr = int(pa)
-                if len(self.pa_cache) > 524288:
-                    self.pa_cache.clear()
-                    # print("{} clear pa_cache".format(datetime.datetime.now()))
-                self.pa_cache[pa_key] = paddr
+                    pte |= MMU.PTE_D
+                self._addrspace.u32[pte_addr] = pte
+            ppn = pte >> 10
+            if superpage:
+                ppn = ppn & ~0x3FF | addr >> 12 & 0x3FF
+            paddr = ppn << 12 | addr & 0xFFF
+            if superpage:
+                self.superpages.add(addr >> 22)
+            writable = pte & MMU.PTE_D and self.allows(pte, superpage, True, False)
         else:
             paddr = addr
-        if write:
-            self._cpu.inst_cache[paddr >> 12].clear()
+            writable = True
+        if fetch_inst:
+            self.itlb.fill(addr, paddr, self.icontext)
+            return paddr
+        code = self._cpu.code_pages[paddr >> 12]  # see TLB
+        mem, index = self._addrspace.backing(paddr)
+        self.dtlb.fill(addr, paddr, self.context, writable, mem, index, code)
         return paddr
 
-    def translate_addr_accel(self, tag, addr, write=False, fetch_inst=False):
-        prev_addr, prev_paddr = self.accel_cache.get(tag, (None, None))
-        if prev_addr and addr ^ prev_addr < 0xFFF:
-            return prev_paddr + addr - prev_addr
-        paddr = self.translate_addr(addr, write, fetch_inst)
-        self.accel_cache[tag] = (addr, paddr)
-        return paddr
+    def allows(self, pte, superpage, write, fetch_inst):
+        """Sv32 leaf pte check for an access in the current mode"""
+        csr = self._cpu.csr
+        if superpage and pte >> 10 & 0x3FF:
+            return False  # misaligned superpage
+        if pte & MMU.PTE_U:
+            if MODE_S == self._cpu.mode and (fetch_inst or not csr.mstatus_SUM):
+                return False
+        elif MODE_U == self._cpu.mode:
+            return False
+        if fetch_inst:
+            return bool(pte & MMU.PTE_X)
+        if write:
+            return bool(pte & MMU.PTE_W)
+        return bool(pte & MMU.PTE_R or csr.mstatus_MXR and pte & MMU.PTE_X)
 
-    def read(self, addr, length):
-        # start_offset = addr&0xfff
-        # end_offset = (addr+length-1)&0xfff
-        # if end_offset < start_offset:   # should not happen
-        #     logger.error("read addr {} length {} across page".format(addr, length))
+    def translate_fetch(self, addr):
+        tlb = self.itlb
+        vpn = addr >> 12
+        slot = (vpn ^ vpn >> 10) & tlb.mask
+        if tlb.tags[slot] == vpn | self.icontext:
+            tlb.hits += 1
+            return addr + tlb.deltas[slot]
+        return self.translate_addr(addr, fetch_inst=True)
 
-        return self._addrspace.read(self.translate_addr_accel(0, addr), length)
+    def read(self, addr, length):
+        tlb = self.dtlb
+        vpn = addr >> 12
+        slot = (vpn ^ vpn >> 10) & tlb.mask
+        try:
+            if tlb.tags[slot] == vpn | self.context:
+                tlb.hits += 1
+                return self._addrspace.read(addr + tlb.deltas[slot], length)
+            return self._addrspace.read(self.translate_addr(addr), length)
+        except addrspace.InvalidAddress:
+            self._cpu.raise_trap(EXCEPTION_LOAD_ACCESS_FAULT, addr)
 
     def write(self, addr, data):
-        # length = len(data)
-        # start_offset = addr&0xfff
-        # end_offset = (addr+length-1)&0xfff
-        # if end_offset < start_offset:
-        #     logger.error("write addr {} length {} across page".format(addr, length))
-
-        self._addrspace.write(self.translate_addr_accel(1, addr, write=True), data)
+        tlb = self.dtlb
+        vpn = addr >> 12
+        slot = (vpn ^ vpn >> 10) & tlb.mask
+        try:
+            if tlb.wtags[slot] == vpn | self.context:
+                tlb.hits += 1
+                self._addrspace.write(addr + tlb.deltas[slot], data)
+                return
+            if tlb.ctags[slot] == vpn | self.context:
+                tlb.hits += 1
+                paddr = addr + tlb.deltas[slot]
+            else:
+                paddr = self.translate_addr(addr, write=True)
+            if self._cpu.code_pages[paddr >> 12]:
+                self._cpu.invalidate_code(paddr, len(data))
+            self._addrspace.write(paddr, data)
+        except addrspace.InvalidAddress:
+            self._cpu.raise_trap(EXCEPTION_STORE_AMO_ACCESS_FAULT, addr)
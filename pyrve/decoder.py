@@ -1,208 +1,202 @@
 import logging
 
-from . import util
-
 logger = logging.getLogger(__name__)
 
-inst_cache = dict()
+# Bits that tell instructions apart, opcode included
+MASK_OPCODE = 0x0000007F
+MASK_FUNCT3 = 0x0000707F
+MASK_FUNCT7 = 0xFE00707F  # also imm[11:5] of shift immediates
+MASK_FUNCT5 = 0xF800707F  # atomics, aq/rl ignored
+MASK_IMM12 = 0xFFF0707F  # SYSTEM and CBO, selected by the whole imm field
 
+_dispatch = None  # [opcode] -> ((mask, {value & mask: inst_class}), ...)
 
-def decode(inst_value):
-    r = inst_cache.get(inst_value)
-    if r:
-        return r
+
+def _build_dispatch():
     from . import inst
 
-    t = inst.InstFormat(inst_value)
-    inst_class = None
-    if 0b0110011 == t.opcode:
-        # Base Reg
-        if 0x1 == t.funct7:  # MUL/DIV
-            if 0x0 == t.funct3:
-                inst_class = inst.MUL
-            elif 0x1 == t.funct3:
-                inst_class = inst.MULH
-            elif 0x2 == t.funct3:
-                inst_class = inst.MULHSU
-            elif 0x3 == t.funct3:
-                inst_class = inst.MULHU
-            elif 0x4 == t.funct3:
-                inst_class = inst.DIV
-            elif 0x5 == t.funct3:
-                inst_class = inst.DIVU
-            elif 0x6 == t.funct3:
-                inst_class = inst.REM
-            elif 0x7 == t.funct3:
-                inst_class = inst.REMU
-            else:
-                pass
-        else:
-            if 0x0 == t.funct3:
-                if 0x0 == t.funct7:
-                    inst_class = inst.ADD
-                elif 0x20 == t.funct7:
-                    inst_class = inst.SUB
-                else:
-                    pass
-            elif 0x4 == t.funct3 and 0x0 == t.funct7:
-                inst_class = inst.XOR
-            elif 0x6 == t.funct3 and 0x0 == t.funct7:
-                inst_class = inst.OR
-            elif 0x7 == t.funct3 and 0x0 == t.funct7:
-                inst_class = inst.AND
-            elif 0x1 == t.funct3 and 0x0 == t.funct7:
-                inst_class = inst.SLL
-            elif 0x5 == t.funct3:
-                if 0x0 == t.funct7:
-                    inst_class = inst.SRL
-                elif 0x20 == t.funct7:
-                    inst_class = inst.SRA
-                else:
-                    pass
-            elif 0x2 == t.funct3 and 0x0 == t.funct7:
-                inst_class = inst.SLT
-            elif 0x3 == t.funct3 and 0x0 == t.funct7:
-                inst_class = inst.SLTU
-            else:
-                pass
-    elif 0b0010011 == t.opcode:  # Base Imm
-        t = inst.Format_I(inst_value)
-        if 0x0 == t.funct3:
-            inst_class = inst.ADDI
-        elif 0x4 == t.funct3:
-            inst_class = inst.XORI
-        elif 0x6 == t.funct3:
-            inst_class = inst.ORI
-        elif 0x7 == t.funct3:
-            inst_class = inst.ANDI
-        elif 0x1 == t.funct3 and 0x0 == util.bitcut(t.imm, 5, 11):
-            inst_class = inst.SLLI
-        elif 0x5 == t.funct3 and 0x0 == util.bitcut(t.imm, 5, 11):
-            inst_class = inst.SRLI
-        elif 0x5 == t.funct3 and 0x20 == util.bitcut(t.imm, 5, 11):
-            inst_class = inst.SRAI
-        elif 0x2 == t.funct3:
-            inst_class = inst.SLTI
-        elif 0x3 == t.funct3:
-            inst_class = inst.SLTIU
-        else:
-            pass
-    elif 0b0000011 == t.opcode:  # Load
-        if 0x0 == t.funct3:
-            inst_class = inst.LB
-        elif 0x1 == t.funct3:
-            inst_class = inst.LH
-        elif 0x2 == t.funct3:
-            inst_class = inst.LW
-        elif 0x4 == t.funct3:
-            inst_class = inst.LBU
-        elif 0x5 == t.funct3:
-            inst_class = inst.LHU
-        else:
-            pass
-    elif 0b0100011 == t.opcode:  # Store
-        if 0x0 == t.funct3:
-            inst_class = inst.SB
-        elif 0x1 == t.funct3:
-            inst_class = inst.SH
-        elif 0x2 == t.funct3:
-            inst_class = inst.SW
-        else:
-            pass
-    elif 0b1100011 == t.opcode:  # Branch
-        if 0x0 == t.funct3:
-            inst_class = inst.BEQ
-        elif 0x1 == t.funct3:
-            inst_class = inst.BNE
-        elif 0x4 == t.funct3:
-            inst_class = inst.BLT
-        elif 0x5 == t.funct3:
-            inst_class = inst.BGE
-        elif 0x6 == t.funct3:
-            inst_class = inst.BLTU
-        elif 0x7 == t.funct3:
-            inst_class = inst.BGEU
-        else:
-            pass
-    elif 0b1101111 == t.opcode:  # Jal
-        inst_class = inst.JAL
-    elif 0b1100111 == t.opcode:  # Jalr
-        if 0x0 == t.funct3:
-            inst_class = inst.JALR
-    elif 0b0110111 == t.opcode:  # Lui
-        inst_class = inst.LUI
-    elif 0b0010111 == t.opcode:  # Auipc
-        inst_class = inst.AUIPC
-    elif 0b1110011 == t.opcode:  # System
-        t = inst.Format_UI(inst_value)
-        if 0x0 == t.funct3:
-            if 0x0 == t.imm:
-                inst_class = inst.ECALL
-            elif 0x1 == t.imm:
-                inst_class = inst.EBREAK
-            elif 0x302 == t.imm:
-                inst_class = inst.MRET
-            elif 0x102 == t.imm:
-                inst_class = inst.SRET
-            elif 0x105 == t.imm:
-                inst_class = inst.WFI
-            elif 0x09 == t.funct7:
-                inst_class = inst.SFENCEvma
-        # CSR
-        elif 0x1 == t.funct3:
-            inst_class = inst.CSRRW
-        elif 0x2 == t.funct3:
-            inst_class = inst.CSRRS
-        elif 0x3 == t.funct3:
-            inst_class = inst.CSRRC
-        elif 0x5 == t.funct3:
-            inst_class = inst.CSRRWI
-        elif 0x6 == t.funct3:
-            inst_class = inst.CSRRSI
-        elif 0x7 == t.funct3:
-            inst_class = inst.CSRRCI
-        else:
-            pass
-    elif 0b0001111 == t.opcode:  # Fence
-        t = inst.Format_I(inst_value)
-        if 0 == t.funct3:
-            inst_class = inst.FENCE
-        if 1 == t.funct3:
-            inst_class = inst.FENCE  # fenci.i, current not use
-        elif 2 == t.funct3:  # CBO
-            if 4 == t.imm:
-                inst_class = inst.CBOzero
-    elif 0b0101111 == t.opcode:  # Atomic
-        t = inst.FORMAT_ATOMIC(inst_value)
-        if 0x2 == t.funct3:
-            if 0x02 == t.funct5:
-                inst_class = inst.LRw
-            elif 0x03 == t.funct5:
-                inst_class = inst.SCw
-            elif 0x01 == t.funct5:
-                inst_class = inst.AMOSWAPw
-            elif 0x00 == t.funct5:
-                inst_class = inst.AMOADDw
-            elif 0x0C == t.funct5:
-                inst_class = inst.AMOANDw
-            elif 0x08 == t.funct5:
-                inst_class = inst.AMOORw
-            elif 0x04 == t.funct5:
-                inst_class = inst.AMOXORw
-            elif 0x14 == t.funct5:
-                inst_class = inst.AMOMAXw
-            elif 0x10 == t.funct5:
-                inst_class = inst.AMOMINw
-            elif 0x18 == t.funct5:
-                inst_class = inst.AMOMINUw
-            elif 0x1C == t.funct5:
-                inst_class = inst.AMOMAXUw
-            else:
-                pass
-    else:
-        pass
-    if not inst_class:
-        raise RuntimeError("Undecode inst({})".format(hex(inst_value)))
-    r = inst_class(inst_value)
-    inst_cache[inst_value] = r
-    return r
+    def op(opcode, funct3=0, funct7=0):
+        return funct7 << 25 | funct3 << 12 | opcode
+
+    def imm12(opcode, funct3, imm):
+        return imm << 20 | funct3 << 12 | opcode
+
+    # per opcode, tables are tried in order, most specific mask first
+    tables = {
+        0b0110011: {  # Base Reg, Mul/Div
+            MASK_FUNCT7: {
+                op(0b0110011, 0x0, 0x00): inst.ADD,
+                op(0b0110011, 0x0, 0x20): inst.SUB,
+                op(0b0110011, 0x4, 0x00): inst.XOR,
+                op(0b0110011, 0x6, 0x00): inst.OR,
+                op(0b0110011, 0x7, 0x00): inst.AND,
+                op(0b0110011, 0x1, 0x00): inst.SLL,
+                op(0b0110011, 0x5, 0x00): inst.SRL,
+                op(0b0110011, 0x5, 0x20): inst.SRA,
+                op(0b0110011, 0x2, 0x00): inst.SLT,
+                op(0b0110011, 0x3, 0x00): inst.SLTU,
+                op(0b0110011, 0x0, 0x01): inst.MUL,
+                op(0b0110011, 0x1, 0x01): inst.MULH,
+                op(0b0110011, 0x2, 0x01): inst.MULHSU,
+                op(0b0110011, 0x3, 0x01): inst.MULHU,
+                op(0b0110011, 0x4, 0x01): inst.DIV,
+                op(0b0110011, 0x5, 0x01): inst.DIVU,
+                op(0b0110011, 0x6, 0x01): inst.REM,
+                op(0b0110011, 0x7, 0x01): inst.REMU,
+            },
+        },
+        0b0010011: {  # Base Imm
+            MASK_FUNCT7: {
+                op(0b0010011, 0x1, 0x00): inst.SLLI,
+                op(0b0010011, 0x5, 0x00): inst.SRLI,
+                op(0b0010011, 0x5, 0x20): inst.SRAI,
+            },
+            MASK_FUNCT3: {
+                op(0b0010011, 0x0): inst.ADDI,
+                op(0b0010011, 0x4): inst.XORI,
+                op(0b0010011, 0x6): inst.ORI,
+                op(0b0010011, 0x7): inst.ANDI,
+                op(0b0010011, 0x2): inst.SLTI,
+                op(0b0010011, 0x3): inst.SLTIU,
+            },
+        },
+        0b0000011: {  # Load
+            MASK_FUNCT3: {
+                op(0b0000011, 0x0): inst.LB,
+                op(0b0000011, 0x1): inst.LH,
+                op(0b0000011, 0x2): inst.LW,
+                op(0b0000011, 0x4): inst.LBU,
+                op(0b0000011, 0x5): inst.LHU,
+            },
+        },
+        0b0100011: {  # Store
+            MASK_FUNCT3: {
+                op(0b0100011, 0x0): inst.SB,
+                op(0b0100011, 0x1): inst.SH,
+                op(0b0100011, 0x2): inst.SW,
+            },
+        },
+        0b1100011: {  # Branch
+            MASK_FUNCT3: {
+                op(0b1100011, 0x0): inst.BEQ,
+                op(0b1100011, 0x1): inst.BNE,
+                op(0b1100011, 0x4): inst.BLT,
+                op(0b1100011, 0x5): inst.BGE,
+                op(0b1100011, 0x6): inst.BLTU,
+                op(0b1100011, 0x7): inst.BGEU,
+            },
+        },
+        0b1101111: {MASK_OPCODE: {0b1101111: inst.JAL}},
+        0b1100111: {MASK_FUNCT3: {op(0b1100111, 0x0): inst.JALR}},
+        0b0110111: {MASK_OPCODE: {0b0110111: inst.LUI}},
+        0b0010111: {MASK_OPCODE: {0b0010111: inst.AUIPC}},
+        0b1110011: {  # System
+            MASK_IMM12: {
+                imm12(0b1110011, 0x0, 0x000): inst.ECALL,
+                imm12(0b1110011, 0x0, 0x001): inst.EBREAK,
+                imm12(0b1110011, 0x0, 0x302): inst.MRET,
+                imm12(0b1110011, 0x0, 0x102): inst.SRET,
+                imm12(0b1110011, 0x0, 0x105): inst.WFI,
+            },
+            MASK_FUNCT7: {op(0b1110011, 0x0, 0x09): inst.SFENCEvma},
+            MASK_FUNCT3: {  # CSR
+                op(0b1110011, 0x1): inst.CSRRW,
+                op(0b1110011, 0x2): inst.CSRRS,
+                op(0b1110011, 0x3): inst.CSRRC,
+                op(0b1110011, 0x5): inst.CSRRWI,
+                op(0b1110011, 0x6): inst.CSRRSI,
+                op(0b1110011, 0x7): inst.CSRRCI,
+            },
+        },
+        0b0001111: {  # Fence
+            MASK_IMM12: {imm12(0b0001111, 0x2, 0x004): inst.CBOzero},
+            MASK_FUNCT3: {
+                op(0b0001111, 0x0): inst.FENCE,
+                op(0b0001111, 0x1): inst.FENCE,  # fenci.i, current not use
+            },
+        },
+        0b0101111: {  # Atomic
+            MASK_FUNCT5: {
+                op(0b0101111, 0x2, 0x02 << 2): inst.LRw,
+                op(0b0101111, 0x2, 0x03 << 2): inst.SCw,
+                op(0b0101111, 0x2, 0x01 << 2): inst.AMOSWAPw,
+                op(0b0101111, 0x2, 0x00 << 2): inst.AMOADDw,
+                op(0b0101111, 0x2, 0x0C << 2): inst.AMOANDw,
+                op(0b0101111, 0x2, 0x08 << 2): inst.AMOORw,
+                op(0b0101111, 0x2, 0x04 << 2): inst.AMOXORw,
+                op(0b0101111, 0x2, 0x14 << 2): inst.AMOMAXw,
+                op(0b0101111, 0x2, 0x10 << 2): inst.AMOMINw,
+                op(0b0101111, 0x2, 0x18 << 2): inst.AMOMINUw,
+                op(0b0101111, 0x2, 0x1C << 2): inst.AMOMAXUw,
+            },
+        },
+    }
+    dispatch = [()] * 128
+    for opcode, masks in tables.items():
+        dispatch[opcode] = tuple(masks.items())
+    return dispatch
+
+
+def opcodes():
+    """All opcodes that decode to some instruction"""
+    global _dispatch
+    if _dispatch is None:
+        _dispatch = _build_dispatch()
+    return [opcode for opcode, tables in enumerate(_dispatch) if tables]
+
+
+def decode(inst_value, fields=None):
+    """fields: optional row of inst.FIELDS for inst_value, see InstFormat"""
+    global _dispatch
+    if _dispatch is None:
+        _dispatch = _build_dispatch()
+    for mask, table in _dispatch[inst_value & MASK_OPCODE]:
+        inst_class = table.get(inst_value & mask)
+        if inst_class:
+            r = inst_class(inst_value, fields)
+            variant = r.specialise()
+            if variant:
+                r.__class__ = variant
+            return r
+    raise RuntimeError("Undecode inst({})".format(hex(inst_value)))
+
+
+class DecodeCache:
+    """
+    Per machine cache of decoded instructions keyed by the instruction word.
+    It holds at most max_size entries, the oldest one is dropped first.
+    """
+
+    MAX_SIZE = 1 << 17
+
+    def __init__(self, max_size=MAX_SIZE) -> None:
+        self.max_size = max_size
+        self._cache = {}  # {inst_value:InstFormat}
+        self.hits = 0
+        self.misses = 0
+
+    def decode(self, inst_value, fields=None):
+        r = self._cache.get(inst_value)
+        if r:
+            self.hits += 1
+            return r
+        r = decode(inst_value, fields)
+        self.misses += 1
+        if len(self._cache) >= self.max_size:
+            del self._cache[next(iter(self._cache))]
+        self._cache[inst_value] = r
+        return r
+
+    def clear(self):
+        self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __contains__(self, inst_value):
+        return inst_value in self._cache
+
+    def __repr__(self) -> str:
+        return "DecodeCache[size:{}/{}, hits:{}, misses:{}]".format(
+            len(self._cache), self.max_size, self.hits, self.misses
+        )
@@ -1,36 +1,102 @@
+import functools
+import logging
 import pathlib
 import sys
 import threading
 
-from . import addrspace, cpu, peripheral, util
+from . import addrspace, cpu, fdt, peripheral, predecode, util
+
+logger = logging.getLogger(__name__)
 
 #           (base, size, name)
-PHYMEM = (0x80000000, 0x04000000, "phy_mem")  # 64MB
-FLASH = (0x20000000, 0x04000000, "flash")  # 64MB
+PHYMEM = (0x80000000, 0x04000000, "phy_mem")  # 64MB by default, see Memory
 UART0 = (0x10000000, 0x00000100, "uart0")
 CLINT = (0x02000000, 0x00010000, "clint")
+PLIC = (0x0C000000, 0x00400000, "plic")
+VIRTIO0 = (0x10001000, 0x00001000, "virtio0")
+
+# PLIC sources
+VIRTIO0_IRQ = 1
+UART0_IRQ = 10
 
 
 class Memory(addrspace.BufferAddrSpace):
 
-    def __init__(self) -> None:
+    def __init__(self, mapped=True, ram_size=PHYMEM[1]) -> None:
+        """
+        mapped: RAM on mmap, see addrspace.MappedAddrSpace, otherwise on a
+        bytearray
+        ram_size: bytes of RAM at PHYMEM[0], whole pages up to 2 GiB. Mapped
+        RAM only takes host memory for the pages the guest writes.
+        """
         super().__init__(0, 0xFFFFFFFF, "memory", False)
-        for memcfg in (PHYMEM, FLASH, CLINT):
-            self.sub_space.append(addrspace.BufferAddrSpace(*memcfg, True))
-        self.sub_space.append(peripheral.UART_8250(UART0[0]))
+        if ram_size <= 0 or ram_size % 4096 or ram_size > (1 << 32) - PHYMEM[0]:
+            raise ValueError("ram_size {} not valid".format(hex(ram_size)))
+        self.ram_size = ram_size
+        if mapped:
+            self.phy_mem = addrspace.MappedAddrSpace(PHYMEM[0], ram_size, PHYMEM[2])
+        else:
+            self.phy_mem = addrspace.BufferAddrSpace(
+                PHYMEM[0], ram_size, PHYMEM[2], True
+            )
+        self.add(self.phy_mem)
+        self.clint = peripheral.CLINT(CLINT[0], CLINT[1])
+        self.add(self.clint)
+        self.plic = peripheral.PLIC(PLIC[0], PLIC[1])
+        self.add(self.plic)
+        self.uart = peripheral.UART_8250(UART0[0])
+        self.add(self.uart)
+        self.uart.irq_listeners.append(
+            functools.partial(self.plic.set_level, UART0_IRQ)
+        )
+        self.disk = peripheral.VirtioBlock(VIRTIO0[0], self, VIRTIO0[1])
+        self.add(self.disk)
+        self.disk.irq_listeners.append(
+            functools.partial(self.plic.set_level, VIRTIO0_IRQ)
+        )
 
 
 class Emulator:
 
-    def __init__(self) -> None:
-        self.memory = Memory()
-        self._cpu = cpu.CPU(self.memory, CLINT[0])
+    def __init__(self, jit=True, icount=0, mapped=True, ram_size=PHYMEM[1]) -> None:
+        """
+        icount: retired instructions per mtime tick for deterministic guest
+        time, 0 to follow the host clock.
+        mapped: back RAM with mmap
+        ram_size: bytes of guest RAM, the device tree is patched to match
+        """
+        self.memory = Memory(mapped, ram_size)
+        self._cpu = cpu.CPU(self.memory, CLINT[0], jit, icount)
+        self.memory.clint.mtimecmp_listeners.append(self._cpu.on_mtimecmp_write)
+        self.memory.map_listeners.append(self._cpu.on_memory_map_change)
+        self.memory.plic.irq_listeners.append(self._cpu.on_external_interrupt)
+        self.memory.disk.dma_listeners.append(self._cpu.invalidate_code)
+        self.memory.uart.rx_listeners.append(
+            functools.partial(self._cpu.call_soon, self.memory.uart.update_irq)
+        )
         self._cpu.pc = PHYMEM[0]
         self.running = False
 
-    def load_linux(self, kernel, rootfs):
-        self.memory.write(PHYMEM[0], util.load_binary(kernel))
-        self.memory.write(FLASH[0], util.load_binary(rootfs))
+    def load_linux(self, kernel, rootfs, persist=False):
+        """
+        rootfs is the virtio disk, mapped and not read in.
+        persist: guest writes go back to rootfs
+        """
+        kernel = bytearray(util.load_binary(kernel))
+        if not fdt.set_memory(kernel, PHYMEM[0], self.memory.ram_size):
+            logger.warning("no memory node in the device tree of the image")
+        # the rootfs moved to the virtio disk, older trees still list the flash
+        fdt.remove_node(kernel, "/soc/flash@20000000")
+        bootargs = fdt.get_property(kernel, "/chosen", "bootargs") or b""
+        if b"mtdblock" in bootargs:
+            logger.warning(
+                "bootargs %r name an mtdblock root, there is no flash any "
+                "more: the root filesystem is /dev/vda",
+                bootargs.rstrip(b"\0").decode(errors="replace"),
+            )
+        self.memory.write(PHYMEM[0], kernel)
+        predecode.predecode(self._cpu.decode_cache, kernel)
+        self.memory.disk.attach(rootfs, persist)
 
     def start(self):
         if self.running:
@@ -47,6 +113,8 @@ class Emulator:
 
     def stop(self):
         self.running = False
+        self._cpu.wakeup.set()
+        self.memory.disk.flush()
 
 
 def main():
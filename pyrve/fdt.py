@@ -0,0 +1,144 @@
+"""
+Flattened device tree patching. The firmware carries the tree built from
+lib/config/pyrve.dts, properties are rewritten in place in the loaded image
+so that it describes the machine actually emulated.
+"""
+
+import struct
+
+FDT_MAGIC = 0xD00DFEED
+FDT_BEGIN_NODE = 1
+FDT_END_NODE = 2
+FDT_PROP = 3
+FDT_NOP = 4
+FDT_END = 9
+
+HEADER = struct.Struct(">10I")
+
+
+def find(data, start=0):
+    """return offset of the first device tree blob in data, -1 if none"""
+    magic = struct.pack(">I", FDT_MAGIC)
+    idx = data.find(magic, start)
+    while idx >= 0:
+        if len(data) - idx >= HEADER.size:
+            _, total, off_struct, off_strings, _, version = HEADER.unpack_from(
+                data, idx
+            )[:6]
+            if (
+                version >= 16
+                and total <= len(data) - idx
+                and off_struct < total
+                and off_strings < total
+            ):
+                return idx
+        idx = data.find(magic, idx + 4)
+    return -1
+
+
+def properties(data, base):
+    """
+    yield (node path, property name, value offset, value length) of the
+    tree at base, offsets relative to data
+    """
+    header = HEADER.unpack_from(data, base)
+    pos = base + header[2]
+    strings = base + header[3]
+    path = []
+    while True:
+        (token,) = struct.unpack_from(">I", data, pos)
+        pos += 4
+        if token == FDT_BEGIN_NODE:
+            end = data.index(b"\0", pos)
+            path.append(bytes(data[pos:end]).decode())
+            pos = (end + 4) & ~3
+        elif token == FDT_END_NODE:
+            path.pop()
+        elif token == FDT_PROP:
+            length, name_off = struct.unpack_from(">II", data, pos)
+            pos += 8
+            name_end = data.index(b"\0", strings + name_off)
+            name = bytes(data[strings + name_off : name_end]).decode()
+            yield "/".join(path) or "/", name, pos, length
+            pos = (pos + length + 3) & ~3
+        elif token == FDT_NOP:
+            pass
+        elif token == FDT_END:
+            return
+        else:
+            raise ValueError("bad fdt token {} at {}".format(token, hex(pos - 4)))
+
+
+def get_property(data, path, name):
+    """return the value of property name of node path, None if not there"""
+    offset = find(data)
+    if offset < 0:
+        return None
+    for node, prop, pos, length in properties(data, offset):
+        if node == path and prop == name:
+            return bytes(data[pos : pos + length])
+    return None
+
+
+def set_memory(data, base, size):
+    """
+    Set the size of the memory node at base in the first tree of data, a
+    bytearray. The value keeps its length so the tree stays valid.
+    return True when the node was found
+    """
+    offset = find(data)
+    if offset < 0:
+        return False
+    cells = {"#address-cells": 2, "#size-cells": 1}
+    for path, name, pos, length in properties(data, offset):
+        if path == "/" and name in cells:
+            (cells[name],) = struct.unpack_from(">I", data, pos)
+        elif path == "/memory@{:x}".format(base) and name == "reg":
+            addr_cells, size_cells = cells["#address-cells"], cells["#size-cells"]
+            if length != (addr_cells + size_cells) * 4:
+                return False
+            fmt = ">{}I".format(size_cells)
+            size_pos = pos + addr_cells * 4
+            words = [size >> 32 * i & 0xFFFFFFFF for i in reversed(range(size_cells))]
+            struct.pack_into(fmt, data, size_pos, *words)
+            return True
+    return False
+
+
+def remove_node(data, path):
+    """
+    Overwrite the node at path, e.g. "/soc/flash@20000000", and its subnodes
+    in the first tree of data, a bytearray, with FDT_NOP.
+    return True when the node was found
+    """
+    base = find(data)
+    if base < 0:
+        return False
+    header = HEADER.unpack_from(data, base)
+    pos = base + header[2]
+    nodes = []
+    start = None
+    while True:
+        (token,) = struct.unpack_from(">I", data, pos)
+        pos += 4
+        if token == FDT_BEGIN_NODE:
+            end = data.index(b"\0", pos)
+            nodes.append(bytes(data[pos:end]).decode())
+            if start is None and "/".join(nodes) == path:
+                start = pos - 4
+            pos = (end + 4) & ~3
+        elif token == FDT_END_NODE:
+            if start is not None and "/".join(nodes) == path:
+                nop = struct.pack(">I", FDT_NOP)
+                data[start:pos] = nop * ((pos - start) // 4)
+                return True
+            nodes.pop()
+        elif token == FDT_PROP:
+            (length,) = struct.unpack_from(">I", data, pos)
+            pos = (pos + 8 + length + 3) & ~3
+        elif token == FDT_NOP:
+            pass
+        elif token == FDT_END:
+            return False
+        else:
+            raise ValueError("bad fdt token {} at {}".format(token, hex(pos - 4)))
@@ -0,0 +1,193 @@
+from . import cpu, inst
+
+M = 0xFFFFFFFF
+SIGN = 0x80000000
+
+
+class Fused:
+    """
+    Two adjacent instructions of a block run as one op by the interpreter.
+    exec leaves the same registers and pc as running both, and a trap in the
+    second half is taken at the second instruction. The interpreter sees a
+    jump as a pc change, so pairs jumping back to their first instruction
+    are not fused.
+    """
+
+    length = 8  # bytes, two instructions
+
+    def __init__(self, first, second) -> None:
+        self.first = first
+        self.second = second
+
+    @staticmethod
+    def match(first, second):
+        return True
+
+    def exec(self, _cpu: cpu.CPU):
+        raise NotImplementedError(self.__class__)
+
+    def __repr__(self) -> str:
+        return "{}[{}, {}]".format(self.__class__.__name__, self.first, self.second)
+
+
+class LUI_ADDI(Fused):
+    """lui rd, hi; addi rd, rd, lo: load a constant"""
+
+    def __init__(self, first, second) -> None:
+        super().__init__(first, second)
+        self.rd = second.wd
+        self.value = ((first.imm << 12) + second.imm) & M
+
+    @staticmethod
+    def match(first, second):
+        return first.rd == second.rd == second.rs1
+
+    def exec(self, _cpu: cpu.CPU):
+        _cpu.regs[self.rd] = self.value
+
+
+class AUIPC_ADDI(Fused):
+    """auipc rd, hi; addi rd, rd, lo: load an address"""
+
+    def __init__(self, first, second) -> None:
+        super().__init__(first, second)
+        self.rd = second.wd
+        self.offset = (first.imm << 12) + second.imm
+
+    match = LUI_ADDI.match
+
+    def exec(self, _cpu: cpu.CPU):
+        _cpu.regs[self.rd] = (_cpu.pc + self.offset) & M
+
+
+class AUIPC_JALR(Fused):
+    """auipc rt, hi; jalr rd, lo(rt): far call or jump"""
+
+    def __init__(self, first, second) -> None:
+        super().__init__(first, second)
+        self.rt = first.wd
+        self.rd = second.wd
+        self.hi = first.imm << 12
+        self.offset = self.hi + second.imm
+
+    @staticmethod
+    def match(first, second):
+        return (
+            first.rd != 0
+            and first.rd == second.rs1
+            and ((first.imm << 12) + second.imm) & ~1 != 0  # not to itself
+        )
+
+    def exec(self, _cpu: cpu.CPU):
+        pc = _cpu.pc
+        _cpu.regs[self.rt] = (pc + self.hi) & M
+        _cpu.pc = (pc + self.offset) & 0xFFFFFFFE
+        _cpu.regs[self.rd] = (pc + 8) & M
+
+
+class AUIPC_LW(Fused):
+    """auipc rt, hi; lw rd, lo(rt): load a pc relative word"""
+
+    def __init__(self, first, second) -> None:
+        super().__init__(first, second)
+        self.rt = first.wd
+        self.rd = second.wd
+        self.hi = first.imm << 12
+        self.lo = second.imm
+
+    @staticmethod
+    def match(first, second):
+        return first.rd != 0 and first.rd == second.rs1
+
+    def exec(self, _cpu: cpu.CPU):
+        base = (_cpu.pc + self.hi) & M
+        _cpu.regs[self.rt] = base
+        try:
+            _cpu.regs[self.rd] = _cpu._addrspace.u32[base + self.lo]
+        except cpu.Trap:
+            _cpu.pc += 4  # auipc retired, the load faults
+            raise
+
+
+class SLT_BRANCH(Fused):
+    """slt[u] rd, rs1, rs2; beq/bne rd, x0: compare and branch on the result"""
+
+    def __init__(self, first, second) -> None:
+        super().__init__(first, second)
+        self.rd = first.rd
+        self.rs1 = first.rs1
+        self.rs2 = first.rs2
+        self.bias = 0 if isinstance(first, (inst.SLTU, inst.SLTIU)) else SIGN
+        self.taken_on = 1 if isinstance(second, inst.BNE) else 0
+        self.imm = second.imm + 4  # relative to the first instruction
+
+    @staticmethod
+    def match(first, second):
+        return (
+            first.rd != 0
+            and (second.rs1, second.rs2) in ((first.rd, 0), (0, first.rd))
+            and second.imm != -4  # a taken branch to first looks not taken
+        )
+
+    def exec(self, _cpu: cpu.CPU):
+        bias = self.bias
+        v = 1 if _cpu.regs[self.rs1] ^ bias < _cpu.regs[self.rs2] ^ bias else 0
+        _cpu.regs[self.rd] = v
+        if v == self.taken_on:
+            _cpu.pc += self.imm
+
+
+class SLTI_BRANCH(SLT_BRANCH):
+    """slti[u] rd, rs1, imm; beq/bne rd, x0"""
+
+    def __init__(self, first, second) -> None:
+        super().__init__(first, second)
+        self.rhs = (first.imm & M) ^ self.bias
+
+    def exec(self, _cpu: cpu.CPU):
+        v = 1 if _cpu.regs[self.rs1] ^ self.bias < self.rhs else 0
+        _cpu.regs[self.rd] = v
+        if v == self.taken_on:
+            _cpu.pc += self.imm
+
+
+PATTERNS = {}  # {(first class, second class):fused class}
+for _first, _second, _fused in (
+    (inst.LUI, inst.ADDI, LUI_ADDI),
+    (inst.AUIPC, inst.ADDI, AUIPC_ADDI),
+    (inst.AUIPC, inst.JALR, AUIPC_JALR),
+    (inst.AUIPC, inst.LW, AUIPC_LW),
+    (inst.SLT, inst.BEQ, SLT_BRANCH),
+    (inst.SLT, inst.BNE, SLT_BRANCH),
+    (inst.SLTU, inst.BEQ, SLT_BRANCH),
+    (inst.SLTU, inst.BNE, SLT_BRANCH),
+    (inst.SLTI, inst.BEQ, SLTI_BRANCH),
+    (inst.SLTI, inst.BNE, SLTI_BRANCH),
+    (inst.SLTIU, inst.BEQ, SLTI_BRANCH),
+    (inst.SLTIU, inst.BNE, SLTI_BRANCH),
+):
+    PATTERNS[(_first, _second)] = _fused
+
+
+def fuse(insts, hits=None):
+    """
+    return the ops to interpret for a block: insts with recognised pairs
+    replaced by Fused ops. hits counts fusions by pattern, the names of the
+    two instructions, e.g. ("SLTU", "BNE").
+    """
+    ops = []
+    idx = 0
+    end = len(insts) - 1
+    while idx < end:
+        first, second = insts[idx], insts[idx + 1]
+        fused = PATTERNS.get((first.kind, second.kind))
+        if fused and fused.match(first, second):
+            ops.append(fused(first, second))
+            if hits is not None:
+                hits[first.kind.__name__, second.kind.__name__] += 1
+            idx += 2
+        else:
+            ops.append(first)
+            idx += 1
+    ops.extend(insts[idx:])
+    return ops
@@ -1,26 +1,73 @@
 import math
+import types
 
 from . import cpu, util
 
 bitcut = util.bitcut
 ru = lambda v: v & 0xFFFFFFFF  # reg value to unsigned
+SIGN = 0x80000000  # x ^ SIGN orders 32-bit values as signed
+
+
+# Fields of a pre-extracted instruction, see InstFormat and predecode.fields
+FIELDS = (
+    "opcode",
+    "rd",
+    "funct3",
+    "rs1",
+    "rs2",
+    "funct7",
+    "imm_i",
+    "imm_s",
+    "imm_b",
+    "imm_u",
+    "imm_j",
+)
 
 
 class InstFormat:
+    """
+    fields, when given, is the row of FIELDS for value, immediates signed.
+    The instruction then takes them as they are instead of cutting them
+    out of value.
+    """
+
+    length = 4  # bytes
+    IMM = None  # index of its immediate form in FIELDS
 
-    def __init__(self, value) -> None:
+    def __init_subclass__(cls, variant=False, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        if not variant:
+            cls.kind = cls  # the decoded instruction, shared by its variants
+
+    def __init__(self, value, fields=None) -> None:
         self.value = value
-        self.opcode = bitcut(self.value, 0, 6)
-        self.rd = bitcut(self.value, 7, 11)
-        self.rs1 = bitcut(self.value, 15, 19)
-        self.rs2 = bitcut(self.value, 20, 24)
-        self.funct3 = bitcut(self.value, 12, 14)
-        self.funct7 = bitcut(self.value, 25, 31)
-        self.imm = None
+        if fields is None:
+            self.opcode = bitcut(self.value, 0, 6)
+            self.rd = bitcut(self.value, 7, 11)
+            self.rs1 = bitcut(self.value, 15, 19)
+            self.rs2 = bitcut(self.value, 20, 24)
+            self.funct3 = bitcut(self.value, 12, 14)
+            self.funct7 = bitcut(self.value, 25, 31)
+            self.imm = None
+        else:
+            self.opcode, self.rd, self.funct3, self.rs1, self.rs2, self.funct7 = (
+                fields[:6]
+            )
+            self.imm = None if self.IMM is None else fields[self.IMM]
+        self.wd = self.rd or cpu.X0_SINK  # index to write rd at
 
     def exec(self, _cpu: cpu.CPU):
         raise NotImplementedError(self.__class__)
 
+    def specialise(self):
+        """
+        return a variant class for these operands or None, the decoder
+        switches the instance to it. See Variants below.
+        """
+        if not self.rd:
+            return NOP_VARIANTS.get(self.kind)
+        return None
+
     def __repr__(self) -> str:
         return "{}[value:{:#x}, opcode:{:b}, funct3:{:#x}, funct7:{:#x}, rs1:{}, rs2:{}, rd:{}, imm:{}]".format(
             self.__class__.__name__,
@@ -36,7 +83,8 @@ class InstFormat:
 
 
 class MayJumpInst:
-    pass
+    # False if the block can go on past it, pc is checked after exec instead
+    ends_block = True
 
 
 class Format_R(InstFormat):
@@ -45,16 +93,24 @@ class Format_R(InstFormat):
 
 class Format_I(InstFormat):
 
-    def __init__(self, value) -> None:
-        super().__init__(value)
+    IMM = FIELDS.index("imm_i")
+
+    def __init__(self, value, fields=None) -> None:
+        super().__init__(value, fields)
+        if fields is not None:
+            return
         r = bitcut(self.value, 20, 31)
         self.imm = util.msb_extend(r, 12, 32)
 
 
 class Format_S(InstFormat):
 
-    def __init__(self, value) -> None:
-        super().__init__(value)
+    IMM = FIELDS.index("imm_s")
+
+    def __init__(self, value, fields=None) -> None:
+        super().__init__(value, fields)
+        if fields is not None:
+            return
         low = bitcut(self.value, 7, 11)
         high = bitcut(self.value, 25, 31)
         r = (high << 5) | low
@@ -63,16 +119,25 @@ class Format_S(InstFormat):
 
 class Format_U(InstFormat):
 
-    def __init__(self, value) -> None:
-        super().__init__(value)
+    IMM = FIELDS.index("imm_u")
+
+    def __init__(self, value, fields=None) -> None:
+        super().__init__(value, fields)
+        if fields is not None:
+            return
         r = bitcut(self.value, 12, 31)
         self.imm = util.msb_extend(r, 20, 32)
 
 
 class Format_B(InstFormat, MayJumpInst):
 
-    def __init__(self, value) -> None:
-        super().__init__(value)
+    ends_block = False  # not taken branch falls through, taken is a side exit
+    IMM = FIELDS.index("imm_b")
+
+    def __init__(self, value, fields=None) -> None:
+        super().__init__(value, fields)
+        if fields is not None:
+            return
         low = bitcut(self.value, 8, 11) << 1
         high = bitcut(self.value, 25, 30) << 5
         r = (
@@ -86,8 +151,12 @@ class Format_B(InstFormat, MayJumpInst):
 
 class Format_J(InstFormat, MayJumpInst):
 
-    def __init__(self, value) -> None:
-        super().__init__(value)
+    IMM = FIELDS.index("imm_j")
+
+    def __init__(self, value, fields=None) -> None:
+        super().__init__(value, fields)
+        if fields is not None:
+            return
         low = bitcut(self.value, 21, 30) << 1
         high = bitcut(self.value, 12, 19) << 12
         r = (
@@ -105,68 +174,64 @@ class Format_J(InstFormat, MayJumpInst):
 class ADD(Format_R):
 
     def exec(self, _cpu: cpu.CPU):
-        _cpu.regs[self.rd] = _cpu.regs[self.rs1] + _cpu.regs[self.rs2]
+        _cpu.regs[self.wd] = ru(_cpu.regs[self.rs1] + _cpu.regs[self.rs2])
 
 
 class SUB(Format_R):
 
     def exec(self, _cpu: cpu.CPU):
-        _cpu.regs[self.rd] = _cpu.regs[self.rs1] - _cpu.regs[self.rs2]
+        _cpu.regs[self.wd] = ru(_cpu.regs[self.rs1] - _cpu.regs[self.rs2])
 
 
 class XOR(Format_R):
 
     def exec(self, _cpu: cpu.CPU):
-        _cpu.regs[self.rd] = _cpu.regs[self.rs1] ^ _cpu.regs[self.rs2]
+        _cpu.regs[self.wd] = _cpu.regs[self.rs1] ^ _cpu.regs[self.rs2]
 
 
 class OR(Format_R):
 
     def exec(self, _cpu: cpu.CPU):
-        _cpu.regs[self.rd] = _cpu.regs[self.rs1] | _cpu.regs[self.rs2]
+        _cpu.regs[self.wd] = _cpu.regs[self.rs1] | _cpu.regs[self.rs2]
 
 
 class AND(Format_R):
 
     def exec(self, _cpu: cpu.CPU):
-        _cpu.regs[self.rd] = _cpu.regs[self.rs1] & _cpu.regs[self.rs2]
+        _cpu.regs[self.wd] = _cpu.regs[self.rs1] & _cpu.regs[self.rs2]
 
 
 class SLL(Format_R):
 
     def exec(self, _cpu: cpu.CPU):
-        _cpu.regs[self.rd] = _cpu.regs[self.rs1] << (_cpu.regs[self.rs2] & 0x1F)
+        _cpu.regs[self.wd] = ru(_cpu.regs[self.rs1] << (_cpu.regs[self.rs2] & 0x1F))
 
 
 class SRL(Format_R):
 
     def exec(self, _cpu: cpu.CPU):
-        _cpu.regs[self.rd] = _cpu.regs[self.rs1] >> (_cpu.regs[self.rs2] & 0x1F)
+        _cpu.regs[self.wd] = _cpu.regs[self.rs1] >> (_cpu.regs[self.rs2] & 0x1F)
 
 
 class SRA(Format_R):
 
     def exec(self, _cpu: cpu.CPU):
-        rs1 = util.msb_extend(
-            _cpu.regs[self.rs1], _cpu.XLEN, _cpu.XLEN + _cpu.regs[self.rs2]
-        )
-        _cpu.regs[self.rd] = rs1 >> (_cpu.regs[self.rs2] & 0x1F)
+        rs1 = (_cpu.regs[self.rs1] ^ SIGN) - SIGN
+        _cpu.regs[self.wd] = ru(rs1 >> (_cpu.regs[self.rs2] & 0x1F))
 
 
 class SLT(Format_R):
 
     def exec(self, _cpu: cpu.CPU):
-        rs1 = util.u2s(_cpu.regs[self.rs1], _cpu.XLEN)
-        rs2 = util.u2s(_cpu.regs[self.rs2], _cpu.XLEN)
-        v = 1 if rs1 < rs2 else 0
-        _cpu.regs[self.rd] = v
+        v = 1 if _cpu.regs[self.rs1] ^ SIGN < _cpu.regs[self.rs2] ^ SIGN else 0
+        _cpu.regs[self.wd] = v
 
 
 class SLTU(Format_R):
 
     def exec(self, _cpu: cpu.CPU):
         v = 1 if _cpu.regs[self.rs1] < _cpu.regs[self.rs2] else 0
-        _cpu.regs[self.rd] = v
+        _cpu.regs[self.wd] = v
 
 
 # Base IMM:
@@ -175,64 +240,71 @@ class SLTU(Format_R):
 class ADDI(Format_I):
 
     def exec(self, _cpu: cpu.CPU):
-        _cpu.regs[self.rd] = _cpu.regs[self.rs1] + self.imm
+        _cpu.regs[self.wd] = ru(_cpu.regs[self.rs1] + self.imm)
+
+    def specialise(self):
+        if self.rd and not self.rs1:
+            return LI
+        if self.rd and not self.imm:
+            return MV
+        return super().specialise()
 
 
 class XORI(Format_I):
 
     def exec(self, _cpu: cpu.CPU):
-        _cpu.regs[self.rd] = _cpu.regs[self.rs1] ^ self.imm
+        _cpu.regs[self.wd] = ru(_cpu.regs[self.rs1] ^ self.imm)
 
 
 class ORI(Format_I):
 
     def exec(self, _cpu: cpu.CPU):
-        _cpu.regs[self.rd] = _cpu.regs[self.rs1] | self.imm
+        _cpu.regs[self.wd] = ru(_cpu.regs[self.rs1] | self.imm)
 
 
 class ANDI(Format_I):
 
     def exec(self, _cpu: cpu.CPU):
-        _cpu.regs[self.rd] = _cpu.regs[self.rs1] & self.imm
+        _cpu.regs[self.wd] = _cpu.regs[self.rs1] & self.imm
 
 
 class SLLI(Format_I):
 
     def exec(self, _cpu: cpu.CPU):
         s = self.imm & 0x1F
-        _cpu.regs[self.rd] = _cpu.regs[self.rs1] << s
+        _cpu.regs[self.wd] = ru(_cpu.regs[self.rs1] << s)
 
 
 class SRLI(Format_I):
 
     def exec(self, _cpu: cpu.CPU):
         s = self.imm & 0x1F
-        _cpu.regs[self.rd] = _cpu.regs[self.rs1] >> s
+        _cpu.regs[self.wd] = _cpu.regs[self.rs1] >> s
 
 
 class SRAI(Format_I):
 
     def exec(self, _cpu: cpu.CPU):
         s = self.imm & 0x1F
-        rs1 = util.msb_extend(
-            _cpu.regs[self.rs1], _cpu.XLEN, _cpu.XLEN + _cpu.regs[self.rs2]
-        )
-        _cpu.regs[self.rd] = rs1 >> s
+        rs1 = (_cpu.regs[self.rs1] ^ SIGN) - SIGN
+        _cpu.regs[self.wd] = ru(rs1 >> s)
 
 
 class SLTI(Format_I):
 
+    def __init__(self, value, fields=None) -> None:
+        super().__init__(value, fields)
+        self.imm_biased = ru(self.imm) ^ SIGN
+
     def exec(self, _cpu: cpu.CPU):
-        rs1 = util.u2s(_cpu.regs[self.rs1], _cpu.XLEN)
-        imm = util.u2s(self.imm, _cpu.XLEN)
-        v = 1 if rs1 < imm else 0
-        _cpu.regs[self.rd] = v
+        v = 1 if _cpu.regs[self.rs1] ^ SIGN < self.imm_biased else 0
+        _cpu.regs[self.wd] = v
 
 
 class SLTIU(Format_I):
 
     def exec(self, _cpu: cpu.CPU):
-        _cpu.regs[self.rd] = 1 if _cpu.regs[self.rs1] < self.imm & 0xFFFFFFFF else 0
+        _cpu.regs[self.wd] = 1 if _cpu.regs[self.rs1] < self.imm & 0xFFFFFFFF else 0
 
 
 # Load Store:
@@ -241,31 +313,31 @@ class SLTIU(Format_I):
 class LB(Format_I):
 
     def exec(self, _cpu: cpu.CPU):
-        _cpu.regs[self.rd] = _cpu._addrspace.s8[_cpu.regs[self.rs1] + self.imm]
+        _cpu.regs[self.wd] = ru(_cpu._addrspace.s8[_cpu.regs[self.rs1] + self.imm])
 
 
 class LH(Format_I):
 
     def exec(self, _cpu: cpu.CPU):
-        _cpu.regs[self.rd] = _cpu._addrspace.s16[_cpu.regs[self.rs1] + self.imm]
+        _cpu.regs[self.wd] = ru(_cpu._addrspace.s16[_cpu.regs[self.rs1] + self.imm])
 
 
 class LW(Format_I):
 
     def exec(self, _cpu: cpu.CPU):
-        _cpu.regs[self.rd] = _cpu._addrspace.u32[_cpu.regs[self.rs1] + self.imm]
+        _cpu.regs[self.wd] = _cpu._addrspace.u32[_cpu.regs[self.rs1] + self.imm]
 
 
 class LBU(Format_I):
 
     def exec(self, _cpu: cpu.CPU):
-        _cpu.regs[self.rd] = _cpu._addrspace.u8[_cpu.regs[self.rs1] + self.imm]
+        _cpu.regs[self.wd] = _cpu._addrspace.u8[_cpu.regs[self.rs1] + self.imm]
 
 
 class LHU(Format_I):
 
     def exec(self, _cpu: cpu.CPU):
-        _cpu.regs[self.rd] = _cpu._addrspace.u16[_cpu.regs[self.rs1] + self.imm]
+        _cpu.regs[self.wd] = _cpu._addrspace.u16[_cpu.regs[self.rs1] + self.imm]
 
 
 class SB(Format_S):
@@ -297,6 +369,9 @@ class BEQ(Format_B):
         if _cpu.regs[self.rs1] == _cpu.regs[self.rs2]:
             _cpu.pc += self.imm
 
+    def specialise(self):
+        return None if self.rs2 else BEQZ
+
 
 class BNE(Format_B):
 
@@ -304,20 +379,37 @@ class BNE(Format_B):
         if _cpu.regs[self.rs1] != _cpu.regs[self.rs2]:
             _cpu.pc += self.imm
 
+    def specialise(self):
+        return None if self.rs2 else BNEZ
+
 
 class BLT(Format_B):
 
     def exec(self, _cpu: cpu.CPU):
-        if util.u2s(_cpu.regs[self.rs1], 32) < util.u2s(_cpu.regs[self.rs2], 32):
+        if _cpu.regs[self.rs1] ^ SIGN < _cpu.regs[self.rs2] ^ SIGN:
             _cpu.pc += self.imm
 
+    def specialise(self):
+        if not self.rs2:
+            return BLTZ
+        if not self.rs1:
+            return BGTZ
+        return None
+
 
 class BGE(Format_B):
 
     def exec(self, _cpu: cpu.CPU):
-        if util.u2s(_cpu.regs[self.rs1], 32) >= util.u2s(_cpu.regs[self.rs2], 32):
+        if _cpu.regs[self.rs1] ^ SIGN >= _cpu.regs[self.rs2] ^ SIGN:
             _cpu.pc += self.imm
 
+    def specialise(self):
+        if not self.rs2:
+            return BGEZ
+        if not self.rs1:
+            return BLEZ
+        return None
+
 
 class BLTU(Format_B):
 
@@ -339,7 +431,7 @@ class BGEU(Format_B):
 class JAL(Format_J):
 
     def exec(self, _cpu: cpu.CPU):
-        _cpu.regs[self.rd] = _cpu.pc + 4
+        _cpu.regs[self.wd] = ru(_cpu.pc + 4)
         _cpu.pc += self.imm
 
 
@@ -348,7 +440,7 @@ class JALR(Format_I, MayJumpInst):
     def exec(self, _cpu: cpu.CPU):
         old_pc = _cpu.pc
         _cpu.pc = (_cpu.regs[self.rs1] + self.imm) & 0xFFFFFFFE
-        _cpu.regs[self.rd] = old_pc + 4
+        _cpu.regs[self.wd] = ru(old_pc + 4)
 
 
 # Upper IMM:
@@ -357,13 +449,13 @@ class JALR(Format_I, MayJumpInst):
 class LUI(Format_U):
 
     def exec(self, _cpu: cpu.CPU):
-        _cpu.regs[self.rd] = self.imm << 12
+        _cpu.regs[self.wd] = ru(self.imm << 12)
 
 
 class AUIPC(Format_U):
 
     def exec(self, _cpu: cpu.CPU):
-        _cpu.regs[self.rd] = _cpu.pc + (self.imm << 12)
+        _cpu.regs[self.wd] = ru(_cpu.pc + (self.imm << 12))
 
 
 # Environment
@@ -371,8 +463,8 @@ class AUIPC(Format_U):
 
 class Format_UI(Format_I):
 
-    def __init__(self, value) -> None:
-        super().__init__(value)
+    def __init__(self, value, fields=None) -> None:
+        super().__init__(value, fields)
         self.imm &= 0xFFF
 
 
@@ -397,88 +489,107 @@ class EBREAK(Format_UI):
 class MRET(Format_UI, MayJumpInst):
 
     def exec(self, _cpu: cpu.CPU):
-        _cpu.pc = _cpu.csr.mepc
-        _cpu.csr.mstatus.MIE = _cpu.csr.mstatus.MPIE
-        _cpu.csr.mstatus.MPIE = 1
-        _cpu.mode = _cpu.csr.mstatus.MPP
-        _cpu.csr.mstatus.MPP = 0  # ?
+        csr = _cpu.csr
+        _cpu.pc = csr.mepc
+        csr.mstatus_MIE = csr.mstatus_MPIE
+        csr.mstatus_MPIE = 1
+        _cpu.mode = csr.mstatus_MPP
+        csr.mstatus_MPP = 0  # ?
 
 
 class SRET(Format_UI, MayJumpInst):
 
     def exec(self, _cpu: cpu.CPU):
-        _cpu.pc = _cpu.csr.sepc
-        _cpu.csr.sstatus.SIE = _cpu.csr.sstatus.SPIE
-        _cpu.csr.sstatus.SPIE = 1
-        _cpu.mode = _cpu.csr.sstatus.SPP
-        _cpu.csr.sstatus.SPP = 0  # ?
+        csr = _cpu.csr
+        _cpu.pc = csr.sepc
+        csr.mstatus_SIE = csr.mstatus_SPIE
+        csr.mstatus_SPIE = 1
+        _cpu.mode = csr.mstatus_SPP
+        csr.mstatus_SPP = 0  # ?
 
 
 class SFENCEvma(Format_R, MayJumpInst):
 
     def exec(self, _cpu: cpu.CPU):
-        if self.rs2 and _cpu.regs[self.rs2] in _cpu._addrspace.pte_cache:
-            _cpu._addrspace.pte_cache[_cpu.regs[self.rs2]].clear()
-        else:
-            _cpu._addrspace.pte_cache.clear()
+        _cpu._addrspace.flush(
+            _cpu.regs[self.rs2] & 0x1FF if self.rs2 else None,  # Sv32 ASID
+            _cpu.regs[self.rs1] if self.rs1 else None,
+        )
 
 
-class WFI(Format_UI):
+class WFI(Format_UI, MayJumpInst):
+    """ends the block so that the interrupt it waited for is taken next"""
 
     def exec(self, _cpu: cpu.CPU):
-        pass
+        _cpu.wait_for_interrupt()
 
 
 # CSR
 
 
-class CSRRW(Format_UI, MayJumpInst):
+class Format_CSR(Format_UI, MayJumpInst):
+
+    # writing these may change address translation, so end the block
+    BLOCK_END_CSRS = (0x100, 0x180, 0x300)  # sstatus, satp, mstatus
+    ALWAYS_WRITE = False
+
+    def __init__(self, value, fields=None) -> None:
+        super().__init__(value, fields)
+        writes = self.ALWAYS_WRITE or self.rs1 != 0
+        self.ends_block = writes and self.imm in Format_CSR.BLOCK_END_CSRS
+
+
+class CSRRW(Format_CSR):
+
+    ALWAYS_WRITE = True
 
     def exec(self, _cpu: cpu.CPU):
         rs1 = _cpu.regs[self.rs1]
         if self.rd:
-            _cpu.regs[self.rd] = _cpu.csr[self.imm]
+            _cpu.regs[self.wd] = _cpu.csr[self.imm]
         _cpu.csr[self.imm] = rs1
 
 
-class CSRRS(Format_UI, MayJumpInst):
+class CSRRS(Format_CSR):
 
     def exec(self, _cpu: cpu.CPU):
         rs1 = _cpu.regs[self.rs1]
-        _cpu.regs[self.rd] = _cpu.csr[self.imm]
+        _cpu.regs[self.wd] = _cpu.csr[self.imm]
         if rs1:
             _cpu.csr[self.imm] |= rs1
 
 
-class CSRRC(Format_UI, MayJumpInst):
+class CSRRC(Format_CSR):
 
     def exec(self, _cpu: cpu.CPU):
         rs1 = _cpu.regs[self.rs1]
-        _cpu.regs[self.rd] = _cpu.csr[self.imm]
+        _cpu.regs[self.wd] = _cpu.csr[self.imm]
         if rs1:
             _cpu.csr[self.imm] &= ~rs1
 
 
-class CSRRWI(Format_UI, MayJumpInst):
+class CSRRWI(Format_CSR):
+
+    ALWAYS_WRITE = True
 
     def exec(self, _cpu: cpu.CPU):
         if self.rd:
-            _cpu.regs[self.rd] = _cpu.csr[self.imm]
+            _cpu.regs[self.wd] = _cpu.csr[self.imm]
         _cpu.csr[self.imm] = self.rs1
 
 
-class CSRRSI(Format_UI, MayJumpInst):
+class CSRRSI(Format_CSR):
 
     def exec(self, _cpu: cpu.CPU):
-        _cpu.regs[self.rd] = _cpu.csr[self.imm]
+        _cpu.regs[self.wd] = _cpu.csr[self.imm]
         if self.rs1:
             _cpu.csr[self.imm] |= self.rs1
 
 
-class CSRRCI(Format_UI, MayJumpInst):
+class CSRRCI(Format_CSR):
 
     def exec(self, _cpu: cpu.CPU):
-        _cpu.regs[self.rd] = _cpu.csr[self.imm]
+        _cpu.regs[self.wd] = _cpu.csr[self.imm]
         if self.rs1:
             _cpu.csr[self.imm] &= ~self.rs1
 
@@ -494,8 +605,8 @@ class FENCE(Format_I):
 
 class FORMAT_ATOMIC(Format_R):
 
-    def __init__(self, value) -> None:
-        super().__init__(value)
+    def __init__(self, value, fields=None) -> None:
+        super().__init__(value, fields)
         self.aq = util.get_bit(self.value, 26)
         self.rl = util.get_bit(self.value, 25)
         self.funct5 = bitcut(self.value, 27, 31)
@@ -505,7 +616,7 @@ class LRw(FORMAT_ATOMIC):
 
     def exec(self, _cpu: cpu.CPU):
         data = _cpu._addrspace.u32[_cpu.regs[self.rs1]]
-        _cpu.regs[self.rd] = data
+        _cpu.regs[self.wd] = data
         _cpu._addrspace.reserve[_cpu] = str(_cpu.regs[self.rs1]) + str(data)
 
 
@@ -515,9 +626,9 @@ class SCw(FORMAT_ATOMIC):
         data = _cpu._addrspace.u32[_cpu.regs[self.rs1]]
         if str(_cpu.regs[self.rs1]) + str(data) == _cpu._addrspace.reserve[_cpu]:
             _cpu._addrspace.u32[_cpu.regs[self.rs1]] = _cpu.regs[self.rs2]
-            _cpu.regs[self.rd] = 0
+            _cpu.regs[self.wd] = 0
         else:
-            _cpu.regs[self.rd] = 1
+            _cpu.regs[self.wd] = 1
         _cpu._addrspace.reserve[_cpu] = None
 
 
@@ -532,9 +643,9 @@ class FORMAT_AMO(FORMAT_ATOMIC):
         mem_value, rd_value = self.get_memvalue_rdvalue(mem_value, rs2_value)
         # logging.debug(_cpu.regs)
         # logging.debug("get_memvalue_rdvalue return {}".format(hex(value)))
-        # store
-        _cpu.regs[self.rd] = rd_value
+        # store, rd is written after it so a store page fault leaves rd intact
         _cpu._addrspace.u32[addr] = mem_value & 0xFFFFFFFF
+        _cpu.regs[self.wd] = rd_value
 
     def get_memvalue_rdvalue(self, mem_value, rs2_value):
         """
@@ -605,7 +716,7 @@ class Format_MULDIV(Format_R):
     def exec(self, _cpu: cpu.CPU):
         rs1 = _cpu.regs[self.rs1]
         rs2 = _cpu.regs[self.rs2]
-        _cpu.regs[self.rd] = self.calc_rd(rs1, rs2)
+        _cpu.regs[self.wd] = ru(self.calc_rd(rs1, rs2))
 
     def calc_rd(self, rs1, rs2):
         raise NotImplementedError()
@@ -686,3 +797,111 @@ class CBOzero(Format_I):
     def exec(self, _cpu: cpu.CPU):
         # print("!!!!!!!!!!!!!!!!!CBO.ZERO {}".format(hex(_cpu.regs[self.rs1])))
         _cpu._addrspace.write(_cpu.regs[self.rs1], bytes(CBOzero.BLOCK_SIZE))
+
+
+# Variants: subclasses picked by specialise() at decode time, so exec skips
+# work the operands make unnecessary. kind still names the instruction.
+
+
+class LI(ADDI, variant=True):
+    """addi rd, x0, imm"""
+
+    def exec(self, _cpu: cpu.CPU):
+        _cpu.regs[self.wd] = ru(self.imm)
+
+
+class MV(ADDI, variant=True):
+    """addi rd, rs1, 0"""
+
+    def exec(self, _cpu: cpu.CPU):
+        _cpu.regs[self.wd] = _cpu.regs[self.rs1]
+
+
+class BEQZ(BEQ, variant=True):
+
+    def exec(self, _cpu: cpu.CPU):
+        if not _cpu.regs[self.rs1]:
+            _cpu.pc += self.imm
+
+
+class BNEZ(BNE, variant=True):
+
+    def exec(self, _cpu: cpu.CPU):
+        if _cpu.regs[self.rs1]:
+            _cpu.pc += self.imm
+
+
+class BLTZ(BLT, variant=True):
+
+    def exec(self, _cpu: cpu.CPU):
+        if _cpu.regs[self.rs1] & SIGN:
+            _cpu.pc += self.imm
+
+
+class BGEZ(BGE, variant=True):
+
+    def exec(self, _cpu: cpu.CPU):
+        if not _cpu.regs[self.rs1] & SIGN:
+            _cpu.pc += self.imm
+
+
+class BGTZ(BLT, variant=True):
+    """blt x0, rs2"""
+
+    def exec(self, _cpu: cpu.CPU):
+        if 0 < _cpu.regs[self.rs2] < SIGN:
+            _cpu.pc += self.imm
+
+
+class BLEZ(BGE, variant=True):
+    """bge x0, rs2"""
+
+    def exec(self, _cpu: cpu.CPU):
+        if not 0 < _cpu.regs[self.rs2] < SIGN:
+            _cpu.pc += self.imm
+
+
+def _nop(self, _cpu: cpu.CPU):
+    pass
+
+
+# rd=x0 and no side effect: nothing to do
+NOP_VARIANTS = {
+    cls: types.new_class(
+        cls.__name__ + "_NOP",
+        (cls,),
+        {"variant": True},
+        lambda ns: ns.update(exec=_nop, __module__=__name__),
+    )
+    for cls in (
+        ADD,
+        SUB,
+        XOR,
+        OR,
+        AND,
+        SLL,
+        SRL,
+        SRA,
+        SLT,
+        SLTU,
+        ADDI,
+        XORI,
+        ORI,
+        ANDI,
+        SLLI,
+        SRLI,
+        SRAI,
+        SLTI,
+        SLTIU,
+        LUI,
+        AUIPC,
+        MUL,
+        MULH,
+        MULHSU,
+        MULHU,
+        DIV,
+        DIVU,
+        REM,
+        REMU,
+    )
+}
@@ -0,0 +1,271 @@
+from . import cpu, inst
+
+M = 0xFFFFFFFF
+SIGN = 0x80000000
+
+
+def _div(a, b):
+    if not b:
+        return M
+    a = (a ^ SIGN) - SIGN
+    b = (b ^ SIGN) - SIGN
+    q = abs(a) // abs(b)
+    return (-q if (a < 0) != (b < 0) else q) & M
+
+
+def _rem(a, b):
+    if not b:
+        return a
+    a = (a ^ SIGN) - SIGN
+    r = abs(a) % abs((b ^ SIGN) - SIGN)
+    return (-r if a < 0 else r) & M
+
+
+def _r(idx):
+    return "x{}".format(idx) if idx else "0"
+
+
+def _s(idx):
+    # signed view of a register
+    return "(({} ^ {}) - {})".format(_r(idx), SIGN, SIGN) if idx else "0"
+
+
+def _imm(i):
+    return i.imm & M
+
+
+# Register-only instructions: inst -> python expression of the new rd value.
+# Skipped entirely when rd is x0.
+
+_EMIT_ALU = {
+    inst.ADD: lambda i: "({} + {}) & {}".format(_r(i.rs1), _r(i.rs2), M),
+    inst.SUB: lambda i: "({} - {}) & {}".format(_r(i.rs1), _r(i.rs2), M),
+    inst.XOR: lambda i: "{} ^ {}".format(_r(i.rs1), _r(i.rs2)),
+    inst.OR: lambda i: "{} | {}".format(_r(i.rs1), _r(i.rs2)),
+    inst.AND: lambda i: "{} & {}".format(_r(i.rs1), _r(i.rs2)),
+    inst.SLL: lambda i: "({} << ({} & 31)) & {}".format(_r(i.rs1), _r(i.rs2), M),
+    inst.SRL: lambda i: "{} >> ({} & 31)".format(_r(i.rs1), _r(i.rs2)),
+    inst.SRA: lambda i: "({} >> ({} & 31)) & {}".format(_s(i.rs1), _r(i.rs2), M),
+    inst.SLT: lambda i: "1 if ({} ^ {}) < ({} ^ {}) else 0".format(
+        _r(i.rs1), SIGN, _r(i.rs2), SIGN
+    ),
+    inst.SLTU: lambda i: "1 if {} < {} else 0".format(_r(i.rs1), _r(i.rs2)),
+    inst.ADDI: lambda i: "({} + {}) & {}".format(_r(i.rs1), i.imm, M),
+    inst.XORI: lambda i: "{} ^ {}".format(_r(i.rs1), _imm(i)),
+    inst.ORI: lambda i: "{} | {}".format(_r(i.rs1), _imm(i)),
+    inst.ANDI: lambda i: "{} & {}".format(_r(i.rs1), _imm(i)),
+    inst.SLLI: lambda i: "({} << {}) & {}".format(_r(i.rs1), i.imm & 0x1F, M),
+    inst.SRLI: lambda i: "{} >> {}".format(_r(i.rs1), i.imm & 0x1F),
+    inst.SRAI: lambda i: "({} >> {}) & {}".format(_s(i.rs1), i.imm & 0x1F, M),
+    inst.SLTI: lambda i: "1 if ({} ^ {}) < {} else 0".format(
+        _r(i.rs1), SIGN, _imm(i) ^ SIGN
+    ),
+    inst.SLTIU: lambda i: "1 if {} < {} else 0".format(_r(i.rs1), _imm(i)),
+    inst.LUI: lambda i: "{}".format((i.imm << 12) & M),
+    inst.MUL: lambda i: "({} * {}) & {}".format(_r(i.rs1), _r(i.rs2), M),
+    inst.MULH: lambda i: "(({} * {}) >> 32) & {}".format(_s(i.rs1), _s(i.rs2), M),
+    inst.MULHSU: lambda i: "(({} * {}) >> 32) & {}".format(_s(i.rs1), _r(i.rs2), M),
+    inst.MULHU: lambda i: "({} * {}) >> 32".format(_r(i.rs1), _r(i.rs2)),
+    inst.DIV: lambda i: "_div({}, {})".format(_r(i.rs1), _r(i.rs2)),
+    inst.DIVU: lambda i: "{0} // {1} if {1} else {2}".format(_r(i.rs1), _r(i.rs2), M),
+    inst.REM: lambda i: "_rem({}, {})".format(_r(i.rs1), _r(i.rs2)),
+    inst.REMU: lambda i: "{0} % {1} if {1} else {0}".format(_r(i.rs1), _r(i.rs2)),
+}
+
+# (accessor, result mask needed)
+_LOADS = {
+    inst.LB: ("_s8", True),
+    inst.LH: ("_s16", True),
+    inst.LW: ("_u32", False),
+    inst.LBU: ("_u8", False),
+    inst.LHU: ("_u16", False),
+}
+
+_STORES = {
+    inst.SB: ("_w8", 0xFF),
+    inst.SH: ("_w16", 0xFFFF),
+    inst.SW: ("_w32", None),
+}
+
+_BRANCHES = {
+    inst.BEQ: lambda i: "{} == {}".format(_r(i.rs1), _r(i.rs2)),
+    inst.BNE: lambda i: "{} != {}".format(_r(i.rs1), _r(i.rs2)),
+    inst.BLT: lambda i: "({} ^ {}) < ({} ^ {})".format(
+        _r(i.rs1), SIGN, _r(i.rs2), SIGN
+    ),
+    inst.BGE: lambda i: "({} ^ {}) >= ({} ^ {})".format(
+        _r(i.rs1), SIGN, _r(i.rs2), SIGN
+    ),
+    inst.BLTU: lambda i: "{} < {}".format(_r(i.rs1), _r(i.rs2)),
+    inst.BGEU: lambda i: "{} >= {}".format(_r(i.rs1), _r(i.rs2)),
+}
+
+_NOPS = (inst.FENCE,)
+
+
+def _reg_written(i):
+    if isinstance(i, (inst.Format_S, inst.Format_B)):
+        return 0
+    return i.rd
+
+
+def _regs_used(i):
+    if isinstance(i, (inst.Format_U, inst.JAL)):
+        return (i.rd,)
+    if isinstance(i, (inst.Format_S, inst.Format_B)):
+        return (i.rs1, i.rs2)
+    if isinstance(i, inst.Format_I):
+        return (i.rd, i.rs1)
+    return (i.rd, i.rs1, i.rs2)
+
+
+class Translator:
+    """
+    Turns a list of decoded instructions into one python function via compile().
+    The function sets cpu.pc and returns how many instructions it executed,
+    fewer than the block length when a conditional branch is taken.
+
+    Registers are loaded into locals on entry and written back on exit
+    (also when a trap unwinds through the block), immediates are inlined as
+    constants and writes to x0 are dropped. Instructions without an emitter
+    are called out to their interpreter exec(), so the generated code stays
+    correct for anything the decoder produces.
+    """
+
+    def __init__(self, _cpu: cpu.CPU) -> None:
+        self._cpu = _cpu
+        mmu = _cpu._addrspace
+        self._globals = {
+            "_regs": _cpu.regs,
+            "_div": _div,
+            "_rem": _rem,
+            "_Trap": cpu.Trap,
+            "_s8": mmu.s8.__getitem__,
+            "_s16": mmu.s16.__getitem__,
+            "_u8": mmu.u8.__getitem__,
+            "_u16": mmu.u16.__getitem__,
+            "_u32": mmu.u32.__getitem__,
+            "_w8": mmu.u8.__setitem__,
+            "_w16": mmu.u16.__setitem__,
+            "_w32": mmu.u32.__setitem__,
+        }
+        self.translated = 0
+
+    def translate(self, insts):
+        regs = sorted({r for i in insts for r in _regs_used(i) if r})
+        written = sorted({_reg_written(i) for i in insts} - {0})
+        callouts = []
+        body = []
+        may_fault = False
+        end_pc = False
+
+        def callout(i, off):
+            callouts.append(i)
+            name = "_i{}".format(len(callouts) - 1)
+            body.extend(_sync_out(written))
+            body.append("cpu.pc = pc0 + {}".format(off))
+            body.append("{}(cpu)".format(name))
+            body.extend(_sync_in(regs))
+
+        for idx, i in enumerate(insts):
+            off = idx * 4
+            last = idx == len(insts) - 1
+            cls = i.kind
+            if cls in _EMIT_ALU:
+                if i.rd:
+                    body.append("x{} = {}".format(i.rd, _EMIT_ALU[cls](i)))
+            elif cls is inst.AUIPC:
+                if i.rd:
+                    body.append(
+                        "x{} = (pc0 + {}) & {}".format(i.rd, (off + (i.imm << 12)), M)
+                    )
+            elif cls in _LOADS:
+                may_fault = True
+                func, sign = _LOADS[cls]
+                body.append("k = {}".format(off))
+                expr = "{}(({} + {}) & {})".format(func, _r(i.rs1), i.imm, M)
+                if sign:
+                    expr += " & {}".format(M)
+                body.append("x{} = {}".format(i.rd, expr) if i.rd else expr)
+            elif cls in _STORES:
+                may_fault = True
+                func, mask = _STORES[cls]
+                body.append("k = {}".format(off))
+                value = _r(i.rs2) if mask is None else "{} & {}".format(_r(i.rs2), mask)
+                body.append(
+                    "{}(({} + {}) & {}, {})".format(func, _r(i.rs1), i.imm, M, value)
+                )
+            elif cls in _NOPS:
+                pass
+            elif cls in _BRANCHES and last:
+                body.append(
+                    "cpu.pc = (pc0 + {}) & {} if {} else pc0 + {}".format(
+                        off + i.imm, M, _BRANCHES[cls](i), off + 4
+                    )
+                )
+                end_pc = True
+            elif cls in _BRANCHES:  # side exit
+                body.append("if {}:".format(_BRANCHES[cls](i)))
+                body.append("    cpu.pc = (pc0 + {}) & {}".format(off + i.imm, M))
+                body.append("    return {}".format(idx + 1))
+            elif cls is inst.JAL and last:
+                if i.rd:
+                    body.append("x{} = (pc0 + {}) & {}".format(i.rd, off + 4, M))
+                body.append("cpu.pc = (pc0 + {}) & {}".format(off + i.imm, M))
+                end_pc = True
+            elif cls is inst.JALR and last:
+                body.append("t = ({} + {}) & {}".format(_r(i.rs1), i.imm, 0xFFFFFFFE))
+                if i.rd:
+                    body.append("x{} = (pc0 + {}) & {}".format(i.rd, off + 4, M))
+                body.append("cpu.pc = t")
+                end_pc = True
+            else:
+                may_fault = True
+                body.append("k = {}".format(off))
+                callout(i, off)
+                if last and isinstance(i, inst.MayJumpInst):
+                    # same rule as the interpreter: no jump means next inst
+                    body.append("if cpu.pc == pc0 + {}:".format(off))
+                    body.append("    cpu.pc = pc0 + {}".format(off + 4))
+                    end_pc = True
+                elif isinstance(i, inst.MayJumpInst):
+                    body.append("if cpu.pc != pc0 + {}:".format(off))
+                    body.append("    return {}".format(idx + 1))
+        if not end_pc:
+            body.append("cpu.pc = pc0 + {}".format(len(insts) * 4))
+        body.append("return {}".format(len(insts)))
+
+        src = ["def block(cpu):", "    pc0 = cpu.pc"]
+        src.extend("    " + line for line in _sync_in(regs))
+        writeback = _sync_out(written)
+        if may_fault or writeback:
+            src.append("    try:")
+            src.extend("        " + line for line in body)
+            if may_fault:
+                src.append("    except _Trap:")
+                src.append("        cpu.pc = pc0 + k")
+                src.append("        raise")
+            if writeback:
+                src.append("    finally:")
+                src.extend("        " + line for line in writeback)
+        else:
+            src.extend("    " + line for line in body)
+        source = "\n".join(src) + "\n"
+
+        ns = dict(self._globals)
+        for idx, i in enumerate(callouts):
+            ns["_i{}".format(idx)] = i.exec
+        code = compile(source, "<jit:{}>".format(hex(id(insts))), "exec")
+        exec(code, ns)
+        self.translated += 1
+        func = ns["block"]
+        func.source = source
+        return func
+
+
+def _sync_in(regs):
+    return ["x{0} = _regs[{0}]".format(r) for r in regs]
+
+
+def _sync_out(regs):
+    return ["_regs[{0}] = x{0}".format(r) for r in regs]
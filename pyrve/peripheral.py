@@ -1,7 +1,10 @@
+import collections
+import functools
 import logging
-import queue
+import mmap
+import os
+import selectors
 import socket
-import socketserver
 import threading
 
 from . import addrspace
@@ -9,72 +12,643 @@ from . import addrspace
 logger = logging.getLogger(__name__)
 
 
-class UART_8250(addrspace.ByteAddrSpace):
+class CLINT(addrspace.BufferAddrSpace):
+
+    MTIMECMP_OFFSET = 0x4000
+
+    def __init__(self, base, size=0x10000) -> None:
+        super().__init__(base, size, "clint@{}".format(hex(base)), True)
+        self.mtimecmp_listeners = []  # called after each mtimecmp write
+
+    def backing(self, addr):
+        return None, 0  # writes must reach the listeners
+
+    def write(self, addr, data):
+        super().write(addr, data)
+        offset = addr - self.base - CLINT.MTIMECMP_OFFSET
+        if -len(data) < offset < 8:
+            for func in self.mtimecmp_listeners:
+                func()
+
+
+class UART_8250(addrspace.RegisterAddrSpace):
+    """
+    8250 console on a TCP socket, the latest client replaces the previous
+    one. The guest side only touches the rx and tx deques. One I/O thread
+    serves the sockets with a selector; it is woken through a socket pair
+    when tx turns non-empty, and sends everything queued by then at once.
+
+    Received data and an empty THR raise the interrupt line as enabled in
+    IER, irq_listeners get its level when it changes. The line is computed
+    on the CPU thread: rx_listeners must arrange update_irq to run there,
+    see CPU.call_soon.
+    """
 
     BUFFER_SIZE = 10 * 1024
+    RECV_SIZE = 4096
+
+    # register offsets, DLL and DLM while LCR.DLAB is set
+    RBR = THR = DLL = 0
+    IER = DLM = 1
+    IIR = FCR = 2
+    LCR = 3
+    MCR = 4
+    LSR = 5
+    SCR = 7
+
+    IER_ERBFI = 1 << 0  # received data available interrupt
+    IER_ETBEI = 1 << 1  # THR empty interrupt
+
+    IIR_NONE = 0x01
+    IIR_THRE = 0x02
+    IIR_RDA = 0x04
+    IIR_FIFO = 0xC0
+
+    LCR_DLAB = 1 << 7
+
+    LSR_DR = 1 << 0  # data ready
+    LSR_THRE = 1 << 5  # transmit holding register empty
+    LSR_TEMT = 1 << 6  # transmitter empty
 
     def __init__(self, base, host="127.0.0.1", port=8250) -> None:
         super().__init__(
-            base, 0x100, "uart_8250@{}[({}, {})]".format(hex(base), host, port), False
+            base, 0x100, "uart_8250@{}[({}, {})]".format(hex(base), host, port)
         )
-        self.read_queue = queue.Queue(UART_8250.BUFFER_SIZE)
-        self.write_queue = queue.Queue(UART_8250.BUFFER_SIZE)
-        self.rw_event = threading.Event()
-        self.server = socketserver.ThreadingTCPServer(
-            (host, port), self._socket_handler, bind_and_activate=False
+        self.regs = [0] * 8  # plain storage of LCR, MCR and SCR
+        self.add_register(UART_8250.RBR, 1, self._read_rbr, self._write_thr)
+        self.add_register(UART_8250.IER, 1, self._read_ier, self._write_ier)
+        self.add_register(UART_8250.IIR, 1, self._read_iir)
+        self.add_register(UART_8250.LSR, 1, self._read_lsr)
+        for offset in (UART_8250.LCR, UART_8250.MCR, UART_8250.SCR):
+            self.add_register(
+                offset,
+                1,
+                functools.partial(self.regs.__getitem__, offset),
+                functools.partial(self.regs.__setitem__, offset),
+            )
+        self.ier = 0
+        self._thre = False  # THR empty interrupt raised, not yet acknowledged
+        self.irq = False
+        self.irq_listeners = []  # called with the new level of the line
+        self.rx = collections.deque()  # received, not read by the guest
+        self.tx = collections.deque()  # written by the guest, not taken to send
+        self._tx_signalled = False
+        self._tx_out = b""  # taken from tx, not sent yet
+        self.rx_listeners = []  # called when input arrives, e.g. to end a WFI
+        self.client = None
+        self.listener = socket.create_server(
+            (host, port), reuse_port=hasattr(socket, "SO_REUSEPORT")
         )
-        self.server.allow_reuse_address = True
-        self.server.allow_reuse_port = True
-        self.server.server_bind()
-        self.server.server_activate()
-        threading.Thread(target=self.server.serve_forever, daemon=True).start()
-        self.client_id = 0
-
-    def _socket_handler(self, request: socket.socket, client_address, server):
-        self.client_id += 1
-        my_client_id = self.client_id
-        request.settimeout(0.01)
-        MAX_HANDLED = 1024
+        self.listener.setblocking(False)
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.listener, selectors.EVENT_READ, self._accept)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, self._wake)
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    # I/O thread
+
+    def _serve(self):
         while True:
-            if my_client_id != self.client_id:
-                return
-            # read
+            for key, events in self._selector.select():
+                key.data(events)
+
+    def _accept(self, events):
+        try:
+            conn, _ = self.listener.accept()
+        except BlockingIOError:
+            return
+        if self.client is not None:
+            self._drop_client()
+        conn.setblocking(False)
+        self.client = conn
+        self._selector.register(conn, selectors.EVENT_READ, self._client_event)
+        self._flush()
+
+    def _drop_client(self):
+        self._selector.unregister(self.client)
+        self.client.close()
+        self.client = None
+        self._tx_out = b""
+
+    def _wake(self, events):
+        try:
+            self._wake_r.recv(UART_8250.RECV_SIZE)
+        except BlockingIOError:
+            pass
+        self._flush()
+
+    def _client_event(self, events):
+        if events & selectors.EVENT_READ:
             try:
-                readed = request.recv(MAX_HANDLED)
-                if readed:
-                    for r in readed:
-                        self.read_queue.put_nowait(r)
-            except (socket.timeout, queue.Full):
-                pass
-            # write
-            sent = 0
-            while sent < MAX_HANDLED and self.write_queue.qsize() > 0:
-                try:
-                    write_char = self.write_queue.get_nowait()
-                    request.send(bytes([write_char]))
-                    sent += 1
-                except (socket.timeout, queue.Empty):
-                    pass
-            if self.write_queue.qsize() == 0:
-                self.rw_event.wait(2)
-                self.rw_event.clear()
-
-    def read_byte(self, addr):
-        self.rw_event.set()
-        result = 0
-        if 0x10000005 == addr:
-            result = 0x60 | (1 if self.read_queue.qsize() != 0 else 0)
-        if 0x10000000 == addr and self.read_queue.qsize() != 0:
+                data = self.client.recv(UART_8250.RECV_SIZE)
+            except BlockingIOError:
+                data = None
+            except OSError:
+                data = b""
+            if data == b"":  # closed
+                self._drop_client()
+                return
+            if data:
+                self.rx.extend(data[: UART_8250.BUFFER_SIZE - len(self.rx)])
+                for func in self.rx_listeners:
+                    func()
+        if events & selectors.EVENT_WRITE:
+            self._flush()
+
+    def _flush(self):
+        """send what the guest wrote, the rest when the socket is writable"""
+        if self.client is None:
+            return  # kept in tx and signalled until a client connects
+        self._tx_signalled = False
+        tx = self.tx
+        if tx:
+            self._tx_out += bytes([tx.popleft() for _ in range(len(tx))])
+        if self._tx_out:
             try:
-                result = self.read_queue.get_nowait()
-            except queue.Empty:
-                pass
-        return result
+                sent = self.client.send(self._tx_out)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                self._drop_client()
+                return
+            self._tx_out = self._tx_out[sent:]
+        events = selectors.EVENT_READ
+        if self._tx_out:
+            events |= selectors.EVENT_WRITE
+        if self._selector.get_key(self.client).events != events:
+            self._selector.modify(self.client, events, self._client_event)
+
+    # guest side
+
+    def update_irq(self):
+        irq = bool(
+            self.ier & UART_8250.IER_ERBFI
+            and self.rx
+            or self.ier & UART_8250.IER_ETBEI
+            and self._thre
+        )
+        if irq != self.irq:
+            self.irq = irq
+            for func in self.irq_listeners:
+                func(irq)
+
+    def _dlab(self):
+        return self.regs[UART_8250.LCR] & UART_8250.LCR_DLAB
+
+    def _read_rbr(self):
+        if self._dlab():
+            return 0
+        try:
+            value = self.rx.popleft()
+        except IndexError:
+            return 0
+        if not self.rx:
+            self.update_irq()
+        return value
+
+    def _read_ier(self):
+        return 0 if self._dlab() else self.ier
 
-    def write_byte(self, addr, value):
-        if 0x10000000 == addr:
+    def _write_ier(self, value):
+        if self._dlab():
+            return  # baud rate divisor, not modelled
+        if value & ~self.ier & UART_8250.IER_ETBEI:
+            self._thre = True  # THR is always empty
+        self.ier = value & (UART_8250.IER_ERBFI | UART_8250.IER_ETBEI)
+        self.update_irq()
+
+    def _read_iir(self):
+        if self.ier & UART_8250.IER_ERBFI and self.rx:
+            iir = UART_8250.IIR_RDA
+        elif self.ier & UART_8250.IER_ETBEI and self._thre:
+            iir = UART_8250.IIR_THRE
+            self._thre = False  # reading IIR acknowledges it
+            self.update_irq()
+        else:
+            iir = UART_8250.IIR_NONE
+        return iir | UART_8250.IIR_FIFO
+
+    def _write_thr(self, value):
+        if self._dlab():
+            return
+        if self.ier & UART_8250.IER_ETBEI:
+            self._thre = True
+            self.update_irq()
+        if len(self.tx) >= UART_8250.BUFFER_SIZE:
+            return  # dropped
+        self.tx.append(value)
+        if not self._tx_signalled:
+            self._tx_signalled = True
             try:
-                self.write_queue.put_nowait(value)
-                self.rw_event.set()
-            except queue.Full:
+                self._wake_w.send(b"\0")
+            except BlockingIOError:
                 pass
+
+    def _read_lsr(self):
+        return UART_8250.LSR_THRE | UART_8250.LSR_TEMT | (
+            UART_8250.LSR_DR if self.rx else 0
+        )
+
+
+class PLIC(addrspace.RegisterAddrSpace):
+    """
+    Platform-level interrupt controller for one hart, sources 1 to
+    NUM_SOURCES - 1 are level triggered. Context 0 is machine mode and
+    context 1 supervisor mode. irq_listeners are called with (context,
+    level) when the interrupt line of a context changes, see
+    CPU.on_external_interrupt.
+    """
+
+    NUM_SOURCES = 32
+    NUM_CONTEXTS = 2
+
+    # register offsets
+    PRIORITY = 0x0  # + 4 * source
+    PENDING = 0x1000
+    ENABLE = 0x2000  # + ENABLE_STRIDE * context
+    ENABLE_STRIDE = 0x80
+    THRESHOLD = 0x200000  # + CONTEXT_STRIDE * context, claim/complete at + 4
+    CONTEXT_STRIDE = 0x1000
+
+    PRIORITY_MASK = 0x7
+
+    def __init__(self, base, size=0x400000) -> None:
+        super().__init__(base, size, "plic@{}".format(hex(base)))
+        self.priority = [0] * PLIC.NUM_SOURCES
+        self.levels = 0  # bitmask of source lines
+        self.pending = 0
+        self.claimed = 0  # claimed and not completed yet
+        self.enable = [0] * PLIC.NUM_CONTEXTS
+        self.threshold = [0] * PLIC.NUM_CONTEXTS
+        self.lines = [False] * PLIC.NUM_CONTEXTS
+        self.irq_listeners = []
+        for source in range(1, PLIC.NUM_SOURCES):
+            self.add_register(
+                PLIC.PRIORITY + 4 * source,
+                4,
+                functools.partial(self.priority.__getitem__, source),
+                functools.partial(self._write_priority, source),
+            )
+        self.add_register(PLIC.PENDING, 4, lambda: self.pending)
+        for ctx in range(PLIC.NUM_CONTEXTS):
+            self.add_register(
+                PLIC.ENABLE + PLIC.ENABLE_STRIDE * ctx,
+                4,
+                functools.partial(self.enable.__getitem__, ctx),
+                functools.partial(self._write_enable, ctx),
+            )
+            offset = PLIC.THRESHOLD + PLIC.CONTEXT_STRIDE * ctx
+            self.add_register(
+                offset,
+                4,
+                functools.partial(self.threshold.__getitem__, ctx),
+                functools.partial(self._write_threshold, ctx),
+            )
+            self.add_register(
+                offset + 4,
+                4,
+                functools.partial(self._claim, ctx),
+                functools.partial(self._complete, ctx),
+            )
+
+    def set_level(self, source, level):
+        """a device drives its interrupt line"""
+        bit = 1 << source
+        if level:
+            self.levels |= bit
+            if not self.claimed & bit:
+                self.pending |= bit
+        else:
+            self.levels &= ~bit
+            self.pending &= ~bit
+        self._update()
+
+    def _best(self, ctx):
+        """return the pending source to deliver to ctx, 0 for none"""
+        candidates = self.pending & self.enable[ctx]
+        best, best_priority = 0, self.threshold[ctx]
+        while candidates:
+            bit = candidates & -candidates
+            source = bit.bit_length() - 1
+            if self.priority[source] > best_priority:
+                best, best_priority = source, self.priority[source]
+            candidates ^= bit
+        return best
+
+    def _update(self):
+        for ctx in range(PLIC.NUM_CONTEXTS):
+            line = self._best(ctx) != 0
+            if line != self.lines[ctx]:
+                self.lines[ctx] = line
+                for func in self.irq_listeners:
+                    func(ctx, line)
+
+    def _write_priority(self, source, value):
+        self.priority[source] = value & PLIC.PRIORITY_MASK
+        self._update()
+
+    def _write_enable(self, ctx, value):
+        self.enable[ctx] = value & ~1  # no source 0
+        self._update()
+
+    def _write_threshold(self, ctx, value):
+        self.threshold[ctx] = value & PLIC.PRIORITY_MASK
+        self._update()
+
+    def _claim(self, ctx):
+        source = self._best(ctx)
+        if source:
+            self.pending &= ~(1 << source)
+            self.claimed |= 1 << source
+            self._update()
+        return source
+
+    def _complete(self, ctx, source):
+        bit = 1 << source
+        if 0 < source < PLIC.NUM_SOURCES and self.claimed & bit:
+            self.claimed &= ~bit
+            if self.levels & bit:
+                self.pending |= bit
+            self._update()
+
+
+class VirtioBlock(addrspace.RegisterAddrSpace):
+    """
+    virtio-mmio (version 2) block device on a host image file, which is
+    mapped, not read in. Private images are copy on write, shared ones
+    take the guest writes.
+
+    A queue notify serves every available request at once: data is copied
+    straight between the mapping and guest RAM and one interrupt signals
+    them all. Requests are expected as Linux queues them: header, data and
+    status in separate descriptors. Requests that do not fit, or whose data
+    descriptors point the wrong way, fail with S_IOERR.
+
+    dma is the physical address space of guest memory. dma_listeners are
+    called with (paddr, length) after the device wrote to it, see
+    CPU.invalidate_code. irq_listeners get the new level of the line.
+    """
+
+    MAGIC = 0x74726976  # "virt"
+    VERSION = 2
+    DEVICE_ID = 2  # block device, 0 while no image is attached
+    VENDOR_ID = 0x45565250  # "PRVE"
+    QUEUE_NUM_MAX = 256
+    SECTOR_SIZE = 512
+
+    FEATURE_FLUSH = 1 << 9
+    FEATURE_VERSION_1 = 1 << 32
+
+    # register offsets
+    MAGIC_VALUE = 0x000
+    VERSION_REG = 0x004
+    DEVICE_ID_REG = 0x008
+    VENDOR_ID_REG = 0x00C
+    DEVICE_FEATURES = 0x010
+    DEVICE_FEATURES_SEL = 0x014
+    DRIVER_FEATURES = 0x020
+    DRIVER_FEATURES_SEL = 0x024
+    QUEUE_SEL = 0x030
+    QUEUE_NUM_MAX_REG = 0x034
+    QUEUE_NUM = 0x038
+    QUEUE_READY = 0x044
+    QUEUE_NOTIFY = 0x050
+    INTERRUPT_STATUS = 0x060
+    INTERRUPT_ACK = 0x064
+    STATUS = 0x070
+    QUEUE_DESC = 0x080  # low, high at + 4
+    QUEUE_DRIVER = 0x090
+    QUEUE_DEVICE = 0x0A0
+    CONFIG_GENERATION = 0x0FC
+    CONFIG = 0x100  # capacity in sectors, 64 bit
+
+    INTERRUPT_USED_BUFFER = 1 << 0
+
+    DESC_F_NEXT = 1
+    DESC_F_WRITE = 2
+    AVAIL_F_NO_INTERRUPT = 1
+
+    # request types and status
+    T_IN = 0
+    T_OUT = 1
+    T_FLUSH = 4
+    T_GET_ID = 8
+    S_OK = 0
+    S_IOERR = 1
+    S_UNSUPP = 2
+
+    def __init__(self, base, dma: addrspace.AddrSpace, size=0x1000) -> None:
+        super().__init__(base, size, "virtio_blk@{}".format(hex(base)))
+        self.dma = dma
+        self.dma_listeners = []
+        self.irq_listeners = []
+        self.irq = False
+        self.image = None  # memoryview of the mapping
+        self._map = None
+        self.shared = False
+        self.requests = 0  # served requests
+        self.notifies = 0  # queue notifies that served any
+        self.reset()
+        r = self.add_register
+        r(VirtioBlock.MAGIC_VALUE, 4, lambda: VirtioBlock.MAGIC)
+        r(VirtioBlock.VERSION_REG, 4, lambda: VirtioBlock.VERSION)
+        r(VirtioBlock.DEVICE_ID_REG, 4, self._read_device_id)
+        r(VirtioBlock.VENDOR_ID_REG, 4, lambda: VirtioBlock.VENDOR_ID)
+        r(VirtioBlock.DEVICE_FEATURES, 4, self._read_features)
+        r(VirtioBlock.DEVICE_FEATURES_SEL, 4, None, self._setter("features_sel"))
+        r(VirtioBlock.DRIVER_FEATURES, 4, None, self._write_driver_features)
+        r(VirtioBlock.DRIVER_FEATURES_SEL, 4, None, self._setter("driver_sel"))
+        r(VirtioBlock.QUEUE_SEL, 4, None, self._setter("queue_sel"))
+        r(VirtioBlock.QUEUE_NUM_MAX_REG, 4, self._read_queue_num_max)
+        r(VirtioBlock.QUEUE_NUM, 4, None, self._setter("queue_num"))
+        r(
+            VirtioBlock.QUEUE_READY,
+            4,
+            lambda: self.queue_ready,
+            self._setter("queue_ready"),
+        )
+        r(VirtioBlock.QUEUE_NOTIFY, 4, None, self._notify)
+        r(VirtioBlock.INTERRUPT_STATUS, 4, lambda: self.interrupt_status)
+        r(VirtioBlock.INTERRUPT_ACK, 4, None, self._ack)
+        r(VirtioBlock.STATUS, 4, lambda: self.status, self._write_status)
+        for offset, name in (
+            (VirtioBlock.QUEUE_DESC, "desc_addr"),
+            (VirtioBlock.QUEUE_DRIVER, "driver_addr"),
+            (VirtioBlock.QUEUE_DEVICE, "device_addr"),
+        ):
+            r(offset, 4, None, functools.partial(self._write_half, name, 0))
+            r(offset + 4, 4, None, functools.partial(self._write_half, name, 32))
+        r(VirtioBlock.CONFIG_GENERATION, 4, lambda: 0)
+        r(VirtioBlock.CONFIG, 4, lambda: self.capacity & 0xFFFFFFFF)
+        r(VirtioBlock.CONFIG + 4, 4, lambda: self.capacity >> 32)
+
+    def attach(self, fname, shared=False):
+        """map the image fname, its size is cut to whole sectors"""
+        with open(fname, "r+b" if shared else "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < VirtioBlock.SECTOR_SIZE:
+                raise ValueError("image {} smaller than a sector".format(fname))
+            access = mmap.ACCESS_WRITE if shared else mmap.ACCESS_COPY
+            self._map = mmap.mmap(f.fileno(), 0, access=access)
+        self.shared = shared
+        self.image = memoryview(self._map)
+        self.capacity = size // VirtioBlock.SECTOR_SIZE
+
+    def flush(self):
+        """write a shared image back"""
+        if self.shared:
+            self._map.flush()
+
+    def reset(self):
+        self.status = 0
+        self.features_sel = 0
+        self.driver_sel = 0
+        self.driver_features = 0
+        self.queue_sel = 0
+        self.queue_num = 0
+        self.queue_ready = 0
+        self.desc_addr = self.driver_addr = self.device_addr = 0
+        self._last_avail = 0  # next avail ring entry to serve
+        self.interrupt_status = 0
+        if self.image is None:
+            self.capacity = 0
+        self._update_irq()
+
+    def _setter(self, name):
+        return functools.partial(setattr, self, name)
+
+    def _write_half(self, name, shift, value):
+        old = getattr(self, name) & ~(0xFFFFFFFF << shift)
+        setattr(self, name, old | value << shift)
+
+    def _read_device_id(self):
+        return VirtioBlock.DEVICE_ID if self.image is not None else 0
+
+    def _read_features(self):
+        features = VirtioBlock.FEATURE_VERSION_1 | VirtioBlock.FEATURE_FLUSH
+        return features >> 32 * self.features_sel & 0xFFFFFFFF
+
+    def _write_driver_features(self, value):
+        shift = 32 * self.driver_sel
+        old = self.driver_features & ~(0xFFFFFFFF << shift)
+        self.driver_features = old | value << shift
+
+    def _read_queue_num_max(self):
+        return VirtioBlock.QUEUE_NUM_MAX if self.queue_sel == 0 else 0
+
+    def _write_status(self, value):
+        if value == 0:
+            self.reset()
+        else:
+            self.status = value
+
+    def _ack(self, value):
+        self.interrupt_status &= ~value
+        self._update_irq()
+
+    def _update_irq(self):
+        irq = self.interrupt_status != 0
+        if irq != self.irq:
+            self.irq = irq
+            for func in self.irq_listeners:
+                func(irq)
+
+    def _notify(self, queue):
+        num = self.queue_num
+        if queue != 0 or not self.queue_ready or not num or self.image is None:
+            return
+        dma = self.dma
+        avail_idx = dma.u16[self.driver_addr + 2]
+        used_idx = dma.u16[self.device_addr + 2]
+        served = 0
+        while self._last_avail != avail_idx:
+            head = dma.u16[self.driver_addr + 4 + 2 * (self._last_avail % num)]
+            written = self._request(head)
+            entry = self.device_addr + 4 + 8 * (used_idx % num)
+            dma.u32[entry] = head
+            dma.u32[entry + 4] = written
+            used_idx = (used_idx + 1) & 0xFFFF
+            self._last_avail = (self._last_avail + 1) & 0xFFFF
+            served += 1
+        if not served:
+            return
+        dma.u16[self.device_addr + 2] = used_idx  # publish after the entries
+        self.requests += served
+        self.notifies += 1
+        if not dma.u16[self.driver_addr] & VirtioBlock.AVAIL_F_NO_INTERRUPT:
+            self.interrupt_status |= VirtioBlock.INTERRUPT_USED_BUFFER
+            self._update_irq()
+
+    def _chain(self, head):
+        """return [(addr, length, flags)] of the descriptor chain at head"""
+        dma = self.dma
+        chain = []
+        idx = head
+        for _ in range(self.queue_num):  # a looping chain ends here
+            desc = self.desc_addr + 16 * idx
+            flags = dma.u16[desc + 12]
+            chain.append((dma.u64[desc], dma.u32[desc + 8], flags))
+            if not flags & VirtioBlock.DESC_F_NEXT:
+                break
+            idx = dma.u16[desc + 14]
+        return chain
+
+    def _request(self, head):
+        """serve one request, return the bytes written to guest memory"""
+        chain = self._chain(head)
+        if len(chain) < 2:
+            self.dma.u8[chain[-1][0]] = VirtioBlock.S_IOERR
+            return 1
+        header = chain[0][0]
+        kind = self.dma.u32[header]
+        offset = self.dma.u64[header + 8] * VirtioBlock.SECTOR_SIZE
+        data = chain[1:-1]
+        status = VirtioBlock.S_OK
+        written = 0
+        # the device writes the data of IN and GET_ID, and reads that of OUT
+        writable = 0 if kind == VirtioBlock.T_OUT else VirtioBlock.DESC_F_WRITE
+        if kind in (VirtioBlock.T_IN, VirtioBlock.T_OUT, VirtioBlock.T_GET_ID) and any(
+            flags & VirtioBlock.DESC_F_WRITE != writable for _, _, flags in data
+        ):
+            status = VirtioBlock.S_IOERR
+        elif kind in (VirtioBlock.T_IN, VirtioBlock.T_OUT):
+            if offset + sum(length for _, length, _ in data) > len(self.image):
+                status = VirtioBlock.S_IOERR
+            elif kind == VirtioBlock.T_IN:
+                for addr, length, _ in data:
+                    self._dma_write(addr, self.image[offset : offset + length])
+                    offset += length
+                    written += length
+            else:
+                for addr, length, _ in data:
+                    self.image[offset : offset + length] = self._dma_read(addr, length)
+                    offset += length
+        elif kind == VirtioBlock.T_FLUSH:
+            self.flush()
+        elif kind == VirtioBlock.T_GET_ID and data:
+            addr, length, _ = data[0]
+            ident = self.name.encode()[:20].ljust(20, b"\0")[:length]
+            self._dma_write(addr, ident)
+            written += len(ident)
+        else:
+            status = VirtioBlock.S_UNSUPP
+        self.dma.u8[chain[-1][0]] = status
+        return written + 1
+
+    def _dma_read(self, addr, length):
+        mem, index = self.dma.backing(addr)
+        if mem is not None and index + length <= len(mem):
+            return mem[index : index + length]
+        return self.dma.read(addr, length)
+
+    def _dma_write(self, addr, data):
+        mem, index = self.dma.backing(addr)
+        if mem is not None and index + len(data) <= len(mem):
+            mem[index : index + len(data)] = data
+        else:
+            self.dma.write(addr, data)
+        for func in self.dma_listeners:
+            func(addr, len(data))
@@ -0,0 +1,198 @@
+"""
+Bulk decode of raw images: fills a decoder.DecodeCache ahead of execution
+and prints the instruction mix or a disassembly of an image.
+
+NumPy is optional. With it the image is viewed as one uint32 array, the
+instruction fields of all words are cut out at once and only the pages
+that look like code are decoded ahead.
+"""
+
+import collections
+import sys
+
+from . import decoder, inst, util
+
+TEXT_PAGE = 4096
+TEXT_THRESHOLD = 0.75  # share of known opcodes that makes a page text
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def words(data):
+    """data as little endian 32-bit words, a numpy array when available"""
+    data = memoryview(data).cast("B")
+    data = data[: len(data) // 4 * 4]
+    np = _numpy()
+    if np is not None:
+        return np.frombuffer(data, dtype="<u4")
+    result = data.cast("I")
+    if sys.byteorder != "little":
+        import array
+
+        result = array.array("I", result)
+        result.byteswap()
+    return result
+
+
+def fields(data):
+    """
+    Instruction fields of every word in data, cut out for all words at once,
+    needs numpy.
+    return {name:int64 array} for the names in inst.FIELDS, immediates sign
+    extended
+    """
+    np = _numpy()
+    w = words(data).astype(np.int64)
+    s = words(data).view(np.int32).astype(np.int64)  # shifts sign extend
+    return {
+        "opcode": w & 0x7F,
+        "rd": (w >> 7) & 0x1F,
+        "funct3": (w >> 12) & 0x7,
+        "rs1": (w >> 15) & 0x1F,
+        "rs2": (w >> 20) & 0x1F,
+        "funct7": w >> 25,
+        "imm_i": s >> 20,
+        "imm_s": (s >> 20) & ~0x1F | (w >> 7) & 0x1F,
+        "imm_b": (s >> 19) & ~0xFFF
+        | (w << 4) & 0x800
+        | (w >> 20) & 0x7E0
+        | (w >> 7) & 0x1E,
+        "imm_u": s >> 12,
+        "imm_j": (s >> 11) & ~0xFFFFF
+        | w & 0xFF000
+        | (w >> 9) & 0x800
+        | (w >> 20) & 0x7FE,
+    }
+
+
+def text_mask(data, threshold=TEXT_THRESHOLD):
+    """
+    bool array, True for the words of data in text: 4 KiB pages in which at
+    least threshold of the words have an opcode the decoder knows. Needs
+    numpy.
+    """
+    np = _numpy()
+    known = np.isin(words(data) & 0x7F, decoder.opcodes())
+    per_page = TEXT_PAGE // 4
+    pages = -(-len(known) // per_page)
+    padded = np.zeros(pages * per_page, dtype=bool)
+    padded[: len(known)] = known
+    text = padded.reshape(pages, per_page).mean(axis=1) >= threshold
+    return np.repeat(text, per_page)[: len(known)] & known
+
+
+def word_counts(data):
+    """
+    {word:count} of the words in data whose opcode the decoder knows.
+    """
+    np = _numpy()
+    if np is None:
+        known = set(decoder.opcodes())
+        counts = collections.Counter(words(data))
+        return {w: c for w, c in counts.items() if w & 0x7F in known}
+    w = words(data)
+    w = w[np.isin(w & 0x7F, decoder.opcodes())]
+    unique, counts = np.unique(w, return_counts=True)
+    return dict(zip(unique.tolist(), counts.tolist()))
+
+
+def _candidates(data, text_only):
+    """
+    yield (word, count, fields row or None) of the distinct words of data
+    with a known opcode, most frequent first. text_only: only the words in
+    text_mask, when numpy is there.
+    """
+    np = _numpy()
+    if np is None:
+        counts = word_counts(data)
+        for w in sorted(counts, key=counts.get, reverse=True):
+            yield w, counts[w], None
+        return
+    w = words(data)
+    if text_only:
+        keep = text_mask(data)
+    else:
+        keep = np.isin(w & 0x7F, decoder.opcodes())
+    unique, first, counts = np.unique(w[keep], return_index=True, return_counts=True)
+    order = np.argsort(-counts, kind="stable")
+    at = np.flatnonzero(keep)[first[order]]
+    columns = fields(data)
+    rows = zip(*(columns[name][at].tolist() for name in inst.FIELDS))
+    yield from zip(unique[order].tolist(), counts[order].tolist(), rows)
+
+
+def predecode(cache: decoder.DecodeCache, data):
+    """
+    Decode the distinct words of the text of data into cache, see
+    text_mask, most frequent first and only into the room the cache has
+    left. Without numpy every word with a known opcode is a candidate.
+    return number of words decoded
+    """
+    room = cache.max_size - len(cache)
+    decoded = 0
+    for w, _, row in _candidates(data, True):
+        if decoded >= room:
+            break
+        if w in cache:
+            continue
+        try:
+            cache.decode(w, row)
+        except RuntimeError:
+            continue
+        decoded += 1
+    return decoded
+
+
+def instruction_mix(data):
+    """
+    return Counter{instruction name:count}, undecodable words under None.
+    Specialised variants count as the instruction they were decoded from.
+    """
+    mix = collections.Counter()
+    for w, count, row in _candidates(data, False):
+        try:
+            mix[decoder.decode(w, row).kind.__name__] += count
+        except RuntimeError:
+            mix[None] += count
+    return mix
+
+
+def disassemble(data, base=0):
+    """yield one line per word: address, word, decoded instruction"""
+    for idx, w in enumerate(words(data)):
+        try:
+            text = repr(decoder.decode(int(w)))
+        except RuntimeError:
+            text = "?"
+        yield "{:#010x}: {:08x}  {}".format(base + idx * 4, int(w), text)
+
+
+def main():
+    """
+    python -m pyrve.predecode image.bin         instruction mix
+    python -m pyrve.predecode image.bin base    disassembly, base in hex
+    """
+    if len(sys.argv) < 2:
+        print(main.__doc__)
+        return
+    data = util.load_binary(sys.argv[1])
+    if len(sys.argv) > 2:
+        for line in disassemble(data, int(sys.argv[2], 16)):
+            print(line)
+        return
+    mix = instruction_mix(data)
+    mix.pop(None, None)
+    total = len(data) // 4
+    print("{} words, {} decodable".format(total, sum(mix.values())))
+    for name, count in mix.most_common():
+        print("{:10} {:10} {:6.2f}%".format(name, count, count * 100 / total))
+
+
+if __name__ == "__main__":
+    main()
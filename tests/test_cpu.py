@@ -0,0 +1,163 @@
+import time
+
+import pytest
+
+from pyrve import addrspace, cpu, peripheral
+
+BASE = 0x80000000
+CLINT = 0x02000000
+
+
+def machine(words=(), icount=0, jit=False):
+    mem = addrspace.BufferAddrSpace(0, 0xFFFFFFFF, "memory", False)
+    mem.add(addrspace.BufferAddrSpace(BASE, 0x10000, "ram", True))
+    mem.add(peripheral.CLINT(CLINT))
+    for idx, word in enumerate(words):
+        mem.u32[BASE + idx * 4] = word
+    _cpu = cpu.CPU(mem, CLINT, jit=jit, icount=icount)
+    _cpu.pc = BASE
+    return _cpu
+
+
+def set_mtimecmp(_cpu, value):
+    _cpu._addrspace_nommu.u64[CLINT + cpu.CPU.MTIMECMP_OFFSET] = value
+
+
+def test_wfi_disarmed_timer_waits_for_input(monkeypatch):
+    monkeypatch.setattr(cpu.CPU, "WFI_MAX_SLEEP", 0.05)
+    _cpu = machine(icount=4)
+    _cpu.csr.mie = cpu.MIP_MTIP
+    set_mtimecmp(_cpu, 0xFFFFFFFFFFFFFFFF)
+    start = time.monotonic()
+    _cpu.wait_for_interrupt()
+    assert time.monotonic() - start >= 0.04
+    assert _cpu.icount_retired == 0
+    _cpu.wakeup.set()
+    start = time.monotonic()
+    _cpu.wait_for_interrupt()
+    assert time.monotonic() - start < 0.04
+    assert _cpu.icount_retired == 0
+
+
+def test_wfi_skip_is_capped():
+    _cpu = machine(icount=4)
+    _cpu.csr.mie = cpu.MIP_MTIP
+    set_mtimecmp(_cpu, 1 << 40)
+    _cpu.wait_for_interrupt()
+    limit = int(cpu.CPU.WFI_MAX_SLEEP * cpu.CPU.TIMEBASE_FREQ) * 4
+    assert _cpu.icount_retired == limit
+    set_mtimecmp(_cpu, 100)
+    _cpu.icount_retired = 0
+    _cpu.wait_for_interrupt()
+    assert _cpu.icount_retired == 400
+
+
+def test_wfi_input_ends_skip():
+    _cpu = machine(icount=4)
+    _cpu.csr.mie = cpu.MIP_MTIP
+    set_mtimecmp(_cpu, 100)
+    _cpu.wakeup.set()
+    _cpu.wait_for_interrupt()
+    assert _cpu.icount_retired == 0
+    assert not _cpu.wakeup.is_set()
+
+
+NOP = 0x00000013  # addi x0, x0, 0
+JAL_BACK = 0xFFDFF06F  # jal x0, -4
+LUI_T0_END = 0x800102B7  # lui t0, 0x80010, the end of RAM
+ADDI_T0_M2048 = 0x80028293  # addi t0, t0, -2048
+CBO_ZERO_T0 = 0x0042A00F  # cbo.zero (t0)
+HANDLER = BASE + 0x100
+
+
+def trapping_machine(words, jit):
+    handler = [0] * (HANDLER - BASE >> 2) + [NOP, JAL_BACK]
+    _cpu = machine(list(words) + handler[len(words) :], jit=jit)
+    _cpu.csr.mtvec = HANDLER
+    return _cpu
+
+
+@pytest.mark.parametrize("jit", [False, True])
+def test_fetch_past_ram_faults(jit):
+    _cpu = trapping_machine([], jit)
+    _cpu.pc = BASE + 0x10000
+    _cpu.run(10)
+    assert _cpu.csr.mcause == cpu.EXCEPTION_INST_ACCESS_FAULT
+    assert _cpu.csr.mtval == BASE + 0x10000
+    assert HANDLER <= _cpu.pc < HANDLER + 8
+
+
+@pytest.mark.parametrize("jit", [False, True])
+def test_cbo_zero_past_ram_faults(jit):
+    _cpu = trapping_machine([LUI_T0_END, ADDI_T0_M2048, CBO_ZERO_T0], jit)
+    _cpu.run(10)
+    assert _cpu.csr.mcause == cpu.EXCEPTION_STORE_AMO_ACCESS_FAULT
+    assert _cpu.csr.mtval == BASE + 0x10000 - 0x800
+    assert _cpu.csr.mepc == BASE + 8
+
+
+def test_trap_keeps_no_host_exception():
+    _cpu = trapping_machine([LUI_T0_END, ADDI_T0_M2048, CBO_ZERO_T0], False)
+    _cpu.run(10)
+    assert _cpu.csr.mcause == cpu.EXCEPTION_STORE_AMO_ACCESS_FAULT
+    assert cpu.TRAP.__context__ is None
+    assert cpu.TRAP.__traceback__ is None
+
+
+JAL_TO_LOOP = 0x1FC0006F  # jal x0, +0x1fc: from BASE + 4 to LOOP
+LOOP = BASE + 0x200
+
+
+def code_page_machine():
+    # a block at BASE jumping to a looping block at LOOP, same page
+    _cpu = machine([NOP, JAL_TO_LOOP] + [0] * 126 + [NOP, JAL_BACK])
+    _cpu.run(20)
+    assert sorted(_cpu.inst_cache[BASE >> 12]) == [BASE, LOOP]
+    return _cpu
+
+
+def dtlb_slot(_cpu, addr):
+    tlb = _cpu._addrspace.dtlb
+    vpn = addr >> 12
+    return tlb, (vpn ^ vpn >> 10) & tlb.mask
+
+
+class ScanCounter(dict):
+    scans = 0
+
+    def items(self):
+        self.scans += 1
+        return super().items()
+
+
+def test_store_to_data_line_keeps_blocks():
+    _cpu = code_page_machine()
+    page = _cpu.inst_cache[BASE >> 12] = ScanCounter(_cpu.inst_cache[BASE >> 12])
+    _cpu._addrspace.u32[BASE + 0x400] = 1
+    tlb, slot = dtlb_slot(_cpu, BASE)
+    misses = tlb.misses
+    _cpu._addrspace.u32[BASE + 0x404] = 2
+    assert tlb.misses == misses  # ctags hit, no walk
+    assert tlb.wtags[slot] == -1 and tlb.ctags[slot] != -1
+    assert sorted(_cpu.inst_cache[BASE >> 12]) == [BASE, LOOP]
+    assert _cpu.smc_writes == 0 and page.scans == 0
+    assert _cpu._addrspace.u32[BASE + 0x404] == 2
+
+
+def test_store_to_code_line_drops_overlapping_blocks():
+    _cpu = code_page_machine()
+    _cpu._addrspace.u32[BASE + 4] = JAL_TO_LOOP
+    assert sorted(_cpu.inst_cache[BASE >> 12]) == [LOOP]
+    assert _cpu.code_lines[BASE >> 12] == 1 << (LOOP & 0xFFF) // 64
+    assert _cpu.smc_writes == 1 and _cpu.smc_blocks == 1
+
+
+def test_last_block_dropped_page_writable_again():
+    _cpu = code_page_machine()
+    _cpu._addrspace.u32[BASE + 0x400] = 1
+    _cpu._addrspace.u32[BASE] = NOP
+    _cpu._addrspace.u32[LOOP] = NOP
+    assert BASE >> 12 not in _cpu.inst_cache
+    assert not _cpu.code_pages[BASE >> 12]
+    tlb, slot = dtlb_slot(_cpu, BASE)
+    assert tlb.wtags[slot] == tlb.tags[slot] != -1 and tlb.ctags[slot] == -1
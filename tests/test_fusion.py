@@ -0,0 +1,43 @@
+import collections
+
+from pyrve import addrspace, cpu, decoder, fusion, peripheral
+
+BASE = 0x80000000
+CLINT = 0x02000000
+
+ADDI_T0_1 = 0x00100293  # addi t0, x0, 1
+SLTU_T1 = 0x00503333  # sltu t1, x0, t0
+BNEZ_T1_BACK = 0xFE031EE3  # bnez t1, -4
+
+
+def machine(words):
+    mem = addrspace.BufferAddrSpace(0, 0xFFFFFFFF, "memory", False)
+    mem.add(addrspace.BufferAddrSpace(BASE, 0x10000, "ram", True))
+    mem.add(peripheral.CLINT(CLINT))
+    for idx, word in enumerate(words):
+        mem.u32[BASE + idx * 4] = word
+    _cpu = cpu.CPU(mem, CLINT, jit=False)
+    _cpu.pc = BASE
+    return _cpu
+
+
+def test_branch_to_first_of_pair_not_fused():
+    insts = [decoder.decode(SLTU_T1), decoder.decode(BNEZ_T1_BACK)]
+    assert fusion.fuse(insts) == insts
+
+
+def test_self_loop_keeps_looping():
+    # 1: sltu t1, x0, t0; bnez t1, 1b
+    _cpu = machine([ADDI_T0_1, SLTU_T1, BNEZ_T1_BACK, ADDI_T0_1])
+    _cpu.run(1000)
+    assert _cpu.pc in (BASE + 4, BASE + 8)
+
+
+def test_hits_counted_per_pattern():
+    SLT_T1 = 0x00502333  # slt t1, x0, t0
+    BNEZ_T1_FWD = 0x00031463  # bnez t1, 8
+    hits = collections.Counter()
+    fusion.fuse([decoder.decode(SLTU_T1), decoder.decode(BNEZ_T1_FWD)], hits)
+    fusion.fuse([decoder.decode(SLT_T1), decoder.decode(BNEZ_T1_FWD)], hits)
+    fusion.fuse([decoder.decode(SLT_T1), decoder.decode(BNEZ_T1_FWD)], hits)
+    assert hits == {("SLTU", "BNE"): 1, ("SLT", "BNE"): 2}
@@ -0,0 +1,36 @@
+import socket
+import time
+
+from pyrve import peripheral
+
+UART = 0x10000000
+
+
+class CountingSocket:
+    def __init__(self, sock) -> None:
+        self.sock = sock
+        self.sends = 0
+
+    def send(self, data):
+        self.sends += 1
+        return self.sock.send(data)
+
+
+def test_uart_without_client_wakes_once():
+    uart = peripheral.UART_8250(UART, port=0)
+    wake = uart._wake_w = CountingSocket(uart._wake_w)
+    for c in b"boot":
+        uart.u8[UART] = c
+    time.sleep(0.05)  # the I/O thread finds no client
+    for c in b" log\n":
+        uart.u8[UART] = c
+    assert wake.sends == 1
+    port = uart.listener.getsockname()[1]
+    with socket.create_connection(("127.0.0.1", port), timeout=2) as conn:
+        data = b""
+        while len(data) < 9:
+            data += conn.recv(64)
+        assert data == b"boot log\n"
+        uart.u8[UART] = ord("!")
+        assert conn.recv(64) == b"!"
+    assert wake.sends == 2
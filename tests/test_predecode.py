@@ -0,0 +1,43 @@
+import random
+
+import pytest
+
+from pyrve import decoder, predecode
+
+np = pytest.importorskip("numpy")
+
+
+def image(values):
+    return b"".join(w.to_bytes(4, "little") for w in values)
+
+
+def code_words(count, seed=1):
+    rng = random.Random(seed)
+    result = []
+    while len(result) < count:
+        w = rng.getrandbits(32) | 3
+        try:
+            decoder.decode(w)
+        except RuntimeError:
+            continue
+        result.append(w)
+    return result
+
+
+def test_fields_build_the_same_instructions():
+    data = image(code_words(5000))
+    for w, _, row in predecode._candidates(data, False):
+        a = decoder.decode(w)
+        b = decoder.decode(w, row)
+        assert type(a) is type(b) and vars(a) == vars(b)
+
+
+def test_predecode_text_only_and_within_room():
+    code = code_words(2048)
+    data = image(code) + random.Random(2).randbytes(8192) + bytes(8192)
+    mask = predecode.text_mask(data)
+    assert mask[: len(code)].all() and not mask[len(code) :].any()
+    cache = decoder.DecodeCache(max_size=100)
+    cache.decode(code[0])
+    assert predecode.predecode(cache, data) == 99
+    assert len(cache) == 100